@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Upload benchmark of the espota engine against EspotaEmulator devices.
+#
+# The emulator runs in its own process so that the CPU time measured here
+# is the cost of the host side only. Every combination of image size,
+# window, chunk size and number of concurrent devices is uploaded and the
+# upload time, throughput and CPU time are reported.
+#
+# use it like: python EspotaBench.py [--sizes 256k,1M,4M] [--windows 1,8] [--jobs 1,4,16] [--latency 5] [--json results.json]
+# To catch regressions, compare with an earlier run:
+# python EspotaBench.py --json new.json --baseline old.json [--tolerance 0.15]
+
+from __future__ import print_function
+import ipaddress
+import json
+import optparse
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import espota
+
+
+class QuietReporter(espota.Reporter):
+  def write(self, text):
+    pass
+
+
+# parse_size() : "256k", "1M" or "4096" to a number of bytes.
+def parse_size(text):
+  units = {'k': 1024, 'm': 1024 * 1024}
+  text = text.strip().lower()
+  if text and text[-1] in units:
+    return int(float(text[:-1]) * units[text[-1]])
+  return int(text)
+
+def parse_list(text, convert = int):
+  return [convert(item) for item in text.split(',') if item.strip()]
+
+# make_image() : random (incompressible) image of size bytes, behind an ESP
+## image header with one segment so that it passes espota.check_image().
+def make_image(size, folder):
+  filename = os.path.join(folder, 'bench-%d.bin' % size)
+  with open(filename, 'wb') as f:
+    # DIO, 16M flash, one segment filling the image
+    f.write(struct.pack('<BBBBI', espota.ESP_MAGIC, 1, 2, 0x90, 0x40100000))
+    f.write(struct.pack('<II', 0x40100000, size - 16))
+    left = size - 16
+    while left > 0:
+      block = min(left, 1 << 20)
+      f.write(os.urandom(block))
+      left -= block
+  return filename
+
+def start_emulator(options, count):
+  args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'EspotaEmulator.py'),
+    '-q', '-i', options.first_ip, '-p', str(options.port), '-n', str(count),
+    '--latency', str(options.latency), '--jitter', str(options.jitter),
+    '--loss', str(options.loss), '--write_delay', str(options.write_delay)]
+  emulator = subprocess.Popen(args, stdout = subprocess.PIPE, universal_newlines = True)
+  line = emulator.stdout.readline()
+  if not line.startswith('READY'):
+    emulator.kill()
+    raise RuntimeError('emulator did not start: ' + line.strip())
+  return emulator
+
+def run_case(filename, size, window, chunk_size, jobs, options):
+  targets = espota.parse_targets(','.join(
+    '%s:%d' % (ip, options.port) for ip in emulated_ips(options.first_ip, jobs)), options.port)
+  reporter = QuietReporter()
+  host_port = random.randint(10000, 60000)
+  cpu = time.process_time()
+  started = time.perf_counter()
+  if jobs == 1:
+    results = [(targets[0], espota.serve(targets[0][0], options.host_ip, targets[0][1], host_port, '',
+      filename, espota.FLASH, reporter, chunk_size = chunk_size, window = window, sendfile = options.sendfile))]
+  else:
+    results = espota.serve_fleet(targets, options.host_ip, host_port, '', filename, espota.FLASH,
+      jobs, reporter, chunk_size = chunk_size, window = window, sendfile = options.sendfile)
+  wall = time.perf_counter() - started
+  cpu = time.process_time() - cpu
+  ok = sum(1 for name, result in results if result == 0)
+  total = size * ok
+  return {
+    'size': size,
+    'window': window,
+    'chunk_size': chunk_size,
+    'jobs': jobs,
+    'ok': ok,
+    'seconds': wall,
+    'bytes_per_second': total / wall if wall else 0.0,
+    'cpu_seconds': cpu,
+    'cpu_seconds_per_mb': cpu / (total / 1048576.0) if total else 0.0,
+  }
+
+def emulated_ips(first_ip, count):
+  first = ipaddress.ip_address(first_ip)
+  return [str(first + i) for i in range(count)]
+
+def case_key(case):
+  return (case['size'], case['window'], case['chunk_size'], case['jobs'])
+
+# compare() : cases slower than the baseline by more than tolerance.
+def compare(cases, baseline, tolerance):
+  reference = dict((case_key(case), case) for case in baseline)
+  regressions = []
+  for case in cases:
+    old = reference.get(case_key(case))
+    if old and old['bytes_per_second'] and case['bytes_per_second'] < old['bytes_per_second'] * (1 - tolerance):
+      regressions.append((case, old))
+  return regressions
+
+def print_case(case):
+  print('%9d %6d %6d %4d %3d %9.3f %9.2f %8.3f %8.4f' % (case['size'], case['window'], case['chunk_size'],
+    case['jobs'], case['ok'], case['seconds'], case['bytes_per_second'] / 1048576.0,
+    case['cpu_seconds'], case['cpu_seconds_per_mb']))
+  sys.stdout.flush()
+
+def parser(unparsed_args):
+  parser = optparse.OptionParser(
+    usage = "%prog [options]",
+    description = "Benchmark OTA uploads against emulated ESP8266 modules."
+  )
+  group = optparse.OptionGroup(parser, "Cases")
+  group.add_option("--sizes",
+    dest = "sizes",
+    help = "Image sizes. Default 256k,1M,4M",
+    default = "256k,1M,4M"
+  )
+  group.add_option("--windows",
+    dest = "windows",
+    help = "Upload windows, 1 is lock-step. Default 1,8",
+    default = "1,8"
+  )
+  group.add_option("--chunk_sizes",
+    dest = "chunk_sizes",
+    help = "Upload chunk sizes. Default 1460",
+    default = "1460"
+  )
+  group.add_option("--jobs",
+    dest = "jobs",
+    help = "Numbers of devices updated concurrently. Default 1,4,16",
+    default = "1,4,16"
+  )
+  group.add_option("--repeat",
+    dest = "repeat",
+    type = "int",
+    help = "Runs of every case, the fastest is kept. Default 1",
+    default = 1
+  )
+  group.add_option("--no_sendfile",
+    dest = "sendfile",
+    action = "store_false",
+    help = "Send the images from memory instead of with sendfile.",
+    default = True
+  )
+  parser.add_option_group(group)
+  group = optparse.OptionGroup(parser, "Devices")
+  group.add_option("-i", "--ip",
+    dest = "first_ip",
+    help = "Address of the first emulated device. Default 127.0.0.2",
+    default = "127.0.0.2"
+  )
+  group.add_option("-p", "--port",
+    dest = "port",
+    type = "int",
+    help = "OTA port of the emulated devices. Default 18266",
+    default = 18266
+  )
+  group.add_option("-I", "--host_ip",
+    dest = "host_ip",
+    help = "Host IP Address. Default 127.0.0.1",
+    default = "127.0.0.1"
+  )
+  group.add_option("--latency", dest = "latency", type = "float", help = "One way delay in ms. Default 2", default = 2.0)
+  group.add_option("--jitter", dest = "jitter", type = "float", help = "Delay variation in ms. Default 0", default = 0.0)
+  group.add_option("--loss", dest = "loss", type = "float", help = "Packet loss probability. Default 0", default = 0.0)
+  group.add_option("--write_delay", dest = "write_delay", type = "float", help = "Flash write time per KiB in ms. Default 0", default = 0.0)
+  parser.add_option_group(group)
+  group = optparse.OptionGroup(parser, "Output")
+  group.add_option("--json",
+    dest = "json",
+    help = "Save the results to FILE.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--baseline",
+    dest = "baseline",
+    help = "Compare the throughput with the results saved in FILE.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--tolerance",
+    dest = "tolerance",
+    type = "float",
+    help = "Throughput drop reported as a regression. Default 0.15",
+    default = 0.15
+  )
+  parser.add_option_group(group)
+  (options, args) = parser.parse_args(unparsed_args)
+  return options
+
+def main(args):
+  options = parser(args)
+  sizes = parse_list(options.sizes, parse_size)
+  windows = parse_list(options.windows)
+  chunk_sizes = parse_list(options.chunk_sizes)
+  jobs = parse_list(options.jobs)
+
+  folder = tempfile.mkdtemp(prefix = 'espota-bench-')
+  emulator = start_emulator(options, max(jobs))
+  cases = []
+  try:
+    print('     size window  chunk jobs  ok    time s      MB/s    cpu s cpu s/MB')
+    for size in sizes:
+      filename = make_image(size, folder)
+      for window in windows:
+        for chunk_size in chunk_sizes:
+          for count in jobs:
+            runs = [run_case(filename, size, window, chunk_size, count, options) for _ in range(max(1, options.repeat))]
+            case = max(runs, key = lambda run: run['bytes_per_second'])
+            print_case(case)
+            cases.append(case)
+      os.remove(filename)
+  finally:
+    emulator.kill()
+    emulator.wait()
+    os.rmdir(folder)
+
+  if options.json:
+    with open(options.json, 'w') as f:
+      json.dump({'conditions': {'latency': options.latency, 'jitter': options.jitter, 'loss': options.loss,
+        'write_delay': options.write_delay}, 'cases': cases}, f, indent = 1)
+  if options.baseline:
+    with open(options.baseline) as f:
+      baseline = json.load(f)['cases']
+    regressions = compare(cases, baseline, options.tolerance)
+    for case, old in regressions:
+      print('REGRESSION size %d window %d chunk %d jobs %d: %.2f MB/s, was %.2f MB/s' % (case['size'],
+        case['window'], case['chunk_size'], case['jobs'], case['bytes_per_second'] / 1048576.0,
+        old['bytes_per_second'] / 1048576.0))
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local stand-in for ESP8266 modules running ArduinoOTA, to test and
+# benchmark EspotaGui without hardware.
+#
+# Each emulated device answers the UDP invitation (with the AUTH nonce
+# challenge when a password is set), connects back to the host, acks every
+# read with the number of bytes written, checks the MD5 and sends "OK".
+#
+# use it like: python EspotaEmulator.py -i 127.0.0.2 -p 8266 -n 10 [-a password] [--latency 5 --jitter 2 --loss 0.01 --write_delay 2]
+# Devices take consecutive addresses from the -i address, on Linux the
+# whole 127.0.0.0/8 range can be used.
+#
+# Network conditions are simulated in the device:
+# - latency/jitter delay every reply and ack (one way, in ms)
+# - loss drops UDP replies; on the TCP side a lost segment costs a
+#   retransmission timeout (--rto) before the ack
+# - write_delay is the flash write time per KiB received
+
+from __future__ import print_function
+import hashlib
+import ipaddress
+import optparse
+import random
+import socket
+import sys
+import threading
+import time
+
+FLASH = 0
+SPIFFS = 100
+AUTH = 200
+# ArduinoOTA reads at most one TCP segment at a time
+BUFFER_SIZE = 1460
+
+
+class Conditions(object):
+  def __init__(self, latency = 0.0, jitter = 0.0, loss = 0.0, rto = 200.0, write_delay = 0.0):
+    self.latency = latency / 1000.0
+    self.jitter = jitter / 1000.0
+    self.loss = loss
+    self.rto = rto / 1000.0
+    self.write_delay = write_delay / 1000.0
+
+  def delay(self):
+    return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+  def lost(self):
+    return self.loss > 0 and random.random() < self.loss
+
+
+# Delayed : sends messages on a socket after a delay, in order, from its own
+## thread, so that latency is pipelined as it is on a real network.
+class Delayed(object):
+  def __init__(self, send):
+    self.send = send
+    self._queue = []
+    self._cond = threading.Condition()
+    self._thread = threading.Thread(target = self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def put(self, delay, data):
+    with self._cond:
+      due = time.time() + delay
+      # messages never overtake each other, as on a TCP stream
+      if self._queue:
+        due = max(due, self._queue[-1][0])
+      self._queue.append((due, data))
+      self._cond.notify()
+
+  def close(self):
+    self.put(0, None)
+    self._thread.join()
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._queue:
+          self._cond.wait()
+        due, data = self._queue.pop(0)
+      if data is None:
+        return
+      wait = due - time.time()
+      if wait > 0:
+        time.sleep(wait)
+      try:
+        self.send(data)
+      except socket.error:
+        return
+
+
+class EmulatedDevice(object):
+  def __init__(self, ip, port = 8266, password = "", conditions = None, log = None):
+    self.ip = ip
+    self.port = port
+    self.password = password
+    self.conditions = conditions or Conditions()
+    self.log = log
+    self.updates = 0
+    self.failures = 0
+    self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._udp.bind((ip, port))
+    self._udp.settimeout(0.2)
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target = self._run)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+    self._udp.close()
+
+  def _say(self, text):
+    if self.log:
+      self.log('%s:%d %s' % (self.ip, self.port, text))
+
+  def _reply(self, data, address):
+    if self.conditions.lost():
+      return
+    time.sleep(self.conditions.delay())
+    self._udp.sendto(data, address)
+
+  def _receive(self):
+    while not self._stop.is_set():
+      try:
+        return self._udp.recvfrom(256)
+      except socket.timeout:
+        continue
+    return None, None
+
+  def _run(self):
+    while not self._stop.is_set():
+      data, address = self._receive()
+      if data is None:
+        return
+      if self.conditions.lost():
+        continue
+      try:
+        command, host_port, size, md5 = data.decode().split()[:4]
+        command, host_port, size = int(command), int(host_port), int(size)
+      except ValueError:
+        self._say('bad invitation %r' % data)
+        continue
+      if command not in (FLASH, SPIFFS):
+        continue
+      if self.password and not self._authenticate(address):
+        continue
+      # Update.begin() refuses an empty image, discovery probes rely on it
+      if size == 0:
+        self._reply(b'ERR: Bad Size Given', address)
+        continue
+      self._reply(b'OK', address)
+      time.sleep(self.conditions.delay())
+      self._update(address[0], host_port, size, md5)
+      # ArduinoOTA ignores the datagrams received during the update
+      self._drain()
+
+  def _drain(self):
+    self._udp.setblocking(False)
+    try:
+      while True:
+        self._udp.recvfrom(256)
+    except socket.error:
+      pass
+    finally:
+      self._udp.settimeout(0.2)
+
+  def _authenticate(self, address):
+    nonce = hashlib.md5(str(random.random()).encode()).hexdigest()
+    self._reply(('AUTH %s' % nonce).encode(), address)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+      data, address = self._receive()
+      if data is None:
+        return False
+      if self.conditions.lost():
+        continue
+      # as ArduinoOTA, anything else than AUTH (a copy of the invitation)
+      ## cancels the authentication without an answer
+      try:
+        command, cnonce, response = data.decode().split()[:3]
+        if int(command) != AUTH:
+          raise ValueError(command)
+      except ValueError:
+        self._say('authentication cancelled')
+        return False
+      passmd5 = hashlib.md5(self.password.encode()).hexdigest()
+      expected = hashlib.md5(('%s:%s:%s' % (passmd5, nonce, cnonce)).encode()).hexdigest()
+      if response != expected:
+        self._say('authentication failed')
+        self._reply(b'Authentication Failed', address)
+        self.failures += 1
+        return False
+      return True
+    return False
+
+  def _update(self, host, host_port, size, md5):
+    try:
+      # from the device address, as a module on the network would
+      connection = socket.create_connection((host, host_port), timeout = 10, source_address = (self.ip, 0))
+    except socket.error as e:
+      self._say('connect back failed: %s' % e)
+      self.failures += 1
+      return
+    acks = Delayed(connection.sendall)
+    digest = hashlib.md5()
+    received = 0
+    started = time.time()
+    try:
+      while received < size:
+        data = connection.recv(min(BUFFER_SIZE, size - received))
+        if not data:
+          break
+        received += len(data)
+        digest.update(data)
+        if self.conditions.write_delay:
+          time.sleep(self.conditions.write_delay * len(data) / 1024.0)
+        delay = self.conditions.delay()
+        if self.conditions.lost():
+          delay += self.conditions.rto
+        acks.put(delay, str(len(data)).encode())
+      if received == size and digest.hexdigest() == md5:
+        acks.put(self.conditions.delay(), b'OK')
+        self.updates += 1
+        self._say('updated, %d bytes in %.2f s' % (received, time.time() - started))
+      else:
+        self.failures += 1
+        self._say('update failed, %d/%d bytes, md5 %s' % (received, size, 'bad' if received == size else '-'))
+    except socket.error as e:
+      self.failures += 1
+      self._say('update failed: %s' % e)
+    finally:
+      acks.close()
+      connection.close()
+
+
+# start_devices() : count devices on consecutive addresses from first_ip.
+def start_devices(first_ip, port, count, password = "", conditions = None, log = None):
+  first = ipaddress.ip_address(first_ip)
+  return [EmulatedDevice(str(first + i), port, password, conditions, log).start() for i in range(count)]
+
+
+def parser(unparsed_args):
+  parser = optparse.OptionParser(
+    usage = "%prog [options]",
+    description = "Emulate ESP8266 modules with OTA support on this computer."
+  )
+  parser.add_option("-i", "--ip",
+    dest = "ip",
+    help = "Address of the first device. Default 127.0.0.2",
+    default = "127.0.0.2"
+  )
+  parser.add_option("-p", "--port",
+    dest = "port",
+    type = "int",
+    help = "OTA port of the devices. Default 8266",
+    default = 8266
+  )
+  parser.add_option("-n", "--count",
+    dest = "count",
+    type = "int",
+    help = "Number of devices. Default 1",
+    default = 1
+  )
+  parser.add_option("-a", "--auth",
+    dest = "auth",
+    help = "Password of the devices.",
+    default = ""
+  )
+  group = optparse.OptionGroup(parser, "Network")
+  group.add_option("--latency",
+    dest = "latency",
+    type = "float",
+    help = "One way delay in ms. Default 0",
+    default = 0.0
+  )
+  group.add_option("--jitter",
+    dest = "jitter",
+    type = "float",
+    help = "Random variation of the delay in ms. Default 0",
+    default = 0.0
+  )
+  group.add_option("--loss",
+    dest = "loss",
+    type = "float",
+    help = "Packet loss probability, 0 to 1. Default 0",
+    default = 0.0
+  )
+  group.add_option("--rto",
+    dest = "rto",
+    type = "float",
+    help = "Delay added by a lost TCP segment in ms. Default 200",
+    default = 200.0
+  )
+  group.add_option("--write_delay",
+    dest = "write_delay",
+    type = "float",
+    help = "Flash write time per KiB in ms. Default 0",
+    default = 0.0
+  )
+  parser.add_option_group(group)
+  group = optparse.OptionGroup(parser, "Output")
+  group.add_option("-q", "--quiet",
+    dest = "quiet",
+    action = "store_true",
+    help = "Do not log the updates.",
+    default = False
+  )
+  parser.add_option_group(group)
+  (options, args) = parser.parse_args(unparsed_args)
+  return options
+
+
+def main(args):
+  options = parser(args)
+  conditions = Conditions(options.latency, options.jitter, options.loss, options.rto, options.write_delay)
+  log = None
+  if not options.quiet:
+    def log(text):
+      print(time.strftime("%H:%M:%S", time.gmtime()) + '[INFO]: ' + text)
+      sys.stdout.flush()
+  try:
+    devices = start_devices(options.ip, options.port, options.count, options.auth, conditions, log)
+  except (socket.error, ValueError) as e:
+    print('[CRITICAL]: ' + str(e))
+    return 1
+  # EspotaBench waits for this line
+  print('READY %d' % len(devices))
+  sys.stdout.flush()
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+  for device in devices:
+    device.stop()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
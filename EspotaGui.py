@@ -36,23 +36,67 @@
 # V1.0.1 2018-11-18
 # validation of values
 # Christophe Caron www.caron.ws
+#Changes
+# V1.1.0
+# - Upload runs in a worker thread, the window stays responsive and the
+#   upload can be cancelled
+# - Several comma separated IP addresses update a fleet of modules
+#   concurrently (-j sets how many at a time)
+# - The image is memory mapped: hashed once in blocks and uploaded from the
+#   same mapping
+# - Windowed upload (-w) keeps several chunks (-c sets their size) in flight
+# - Image digests are cached by path, size and mtime (--cache, --no_cache)
+# - Gzip compressed upload (-z), the compressed image is kept in the cache
+# - Log and progress are rendered at a fixed frame rate, the log is bounded
+# - Per phase timings as events, exported as JSON lines (--metrics) or for
+#   Prometheus (--prometheus)
+# - Device discovery by mDNS (--mdns) and network scan (--scan), the
+#   devices found are kept for later runs (--known), Discover button
+# - Transient failures are retried with backoff (--retries, --retry_delay),
+#   a wrong password or a bad image fails at once
+# - One host port for the connect-backs of a whole fleet (--shared_port)
+# - The engine moved to espota.py, a command line tool without Qt; the
+#   window passes its options to it without touching sys.argv
+# - The image is sent with sendfile (no copy through Python), the window
+#   room is sent in one call; --no_sendfile sends from memory
+# - Timeouts follow the measured round trips of every device and of the
+#   fleet, between --timeout_min and --timeout_max
+# - Staged rollout (--canary, --growth, --max_failure): canary devices
+#   first, then growing waves while the failures stay under the limit; a
+#   stopped rollout resumes from its state file (--state)
+# - Upload rate limits shared by the sessions: total (--max_rate) and per
+#   subnet (--group_rate, --group_prefix)
+# - The image headers are checked before anything is sent (magic byte,
+#   segments, flash mode and size, fit; SPIFFS/LittleFS blocks), also when
+#   a file is selected; --flash_size gives the flash of the devices
+# - Every update is recorded in a ledger (--ledger, --no_ledger);
+#   --skip_deployed sends nothing to the devices already up to date
+# - Device inventory (--inventory) with per-device port, password and
+#   group, filled from CSV or JSON (--import); --group, --subnet and
+#   --firmware select the devices to update
+# - Dashboard (Dashboard button, opened for a fleet): one row per module
+#   with state, phase, bytes sent, rate, time and error, and the log of the
+#   selected module; the rows are refreshed in batches at the frame rate
+# - Protocol trace of every session (--trace, always ~/.espota/last.trace
+#   from the window), replayed against the engine by EspotaReplay.py
+# - The invitation and the authentication are sent again at growing
+#   intervals until answered, instead of waiting out the whole timeout for
+#   a lost datagram; duplicate answers are dropped
+# - The whole fleet is probed before the update (--probe, always for a
+#   fleet from the window), unreachable modules are skipped; the answers
+#   are trusted for --probe_ttl seconds
+# - Watch folder (--watch, Watch button): every new or changed image of the
+#   folder is sent to the modules once it has not changed for --settle
+#   seconds; an image is only hashed after its size or mtime changed, and
+#   is not sent again if its digest did not change
 
 from __future__ import print_function
-import socket
+import collections
+import ipaddress
 import sys
-import os
-import optparse
-import hashlib
-import random
+import threading
 import time
 
-# Commands
-FLASH = 0
-SPIFFS = 100
-AUTH = 200
-PROGRESS = False
-
-
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QDir, Qt
 from PyQt5.QtGui import QFont, QPalette
@@ -60,10 +104,19 @@ from PyQt5.QtWidgets import (QApplication, QCheckBox, QColorDialog, QDialog,
         QErrorMessage, QFileDialog, QFontDialog, QFrame, QGridLayout,
         QInputDialog, QLabel, QLineEdit, QMessageBox, QPushButton,QAction)
 
-import ipaddress
+# the OTA engine, it runs without Qt as well: python espota.py -h
+from espota import (FLASH, SPIFFS, TRACE_FILE, FolderWatcher, Image, Reporter, check_image, digest_cache, flashing,
+        load_devices, local_network, parse_targets)
 
 
 class Ui_Form(QtWidgets.QWidget):
+    FRAME_RATE = 30
+    MAX_LOG_LINES = 2000
+    # seconds an image of the watched folder must stay unchanged
+    WATCH_SETTLE = 2.0
+    # to the FolderWorker, in its thread
+    pollRequested = QtCore.pyqtSignal()
+
     def setupUi(self, Form):
         Form.setObjectName("Form")
         Form.resize(512, 480)
@@ -78,6 +131,13 @@ class Ui_Form(QtWidgets.QWidget):
         font.setWeight(75)
         self.checkBox_SIPFFS.setFont(font)
         self.checkBox_SIPFFS.setObjectName("checkBox_SIPFFS")
+        self.checkBox_Compression = QtWidgets.QCheckBox(Form)
+        self.checkBox_Compression.setGeometry(QtCore.QRect(400, 104, 108, 17))
+        font = QtGui.QFont()
+        font.setBold(True)
+        font.setWeight(75)
+        self.checkBox_Compression.setFont(font)
+        self.checkBox_Compression.setObjectName("checkBox_Compression")
         self.label_Tx_Chemin = QtWidgets.QLabel(Form)
         self.label_Tx_Chemin.setGeometry(QtCore.QRect(0, 26, 121, 31))
         font = QtGui.QFont()
@@ -238,6 +298,29 @@ class Ui_Form(QtWidgets.QWidget):
         font.setWeight(75)
         self.pushButton_EN.setFont(font)
         self.pushButton_EN.setObjectName("pushButton_EN")
+        self.pushButton_Decouverte = QtWidgets.QPushButton(Form)
+        self.pushButton_Decouverte.setGeometry(QtCore.QRect(400, 158, 107, 27))
+        font = QtGui.QFont()
+        font.setBold(True)
+        font.setWeight(75)
+        self.pushButton_Decouverte.setFont(font)
+        self.pushButton_Decouverte.setObjectName("pushButton_Decouverte")
+        self.pushButton_Suivi = QtWidgets.QPushButton(Form)
+        self.pushButton_Suivi.setGeometry(QtCore.QRect(400, 126, 107, 27))
+        font = QtGui.QFont()
+        font.setBold(True)
+        font.setWeight(75)
+        self.pushButton_Suivi.setFont(font)
+        self.pushButton_Suivi.setObjectName("pushButton_Suivi")
+        self.pushButton_Surveiller = QtWidgets.QPushButton(Form)
+        self.pushButton_Surveiller.setGeometry(QtCore.QRect(400, 190, 107, 27))
+        font = QtGui.QFont()
+        font.setBold(True)
+        font.setWeight(75)
+        self.pushButton_Surveiller.setFont(font)
+        self.pushButton_Surveiller.setCheckable(True)
+        self.pushButton_Surveiller.setObjectName("pushButton_Surveiller")
+        self.dashboard = Dashboard()
 
         self.messageBox = QMessageBox()
         self.messageBox.setIcon(QMessageBox.Information)
@@ -256,6 +339,32 @@ class Ui_Form(QtWidgets.QWidget):
         self.pushButton_Fichier.clicked.connect(self.setOpenFileName)
         self.pushButton_MaJ.clicked.connect(CdeFlash)
         self.pushButton_EN.clicked.connect(Traduction)  
+        self.pushButton_Decouverte.clicked.connect(CdeDecouverte)
+        self.pushButton_Suivi.clicked.connect(self.showDashboard)
+        self.pushButton_Surveiller.toggled.connect(self.watchFolder)
+
+        self.thread = None
+        self.worker = None
+        self.discovering = False
+        # the log keeps its last lines only
+        self.textEdit.document().setMaximumBlockCount(self.MAX_LOG_LINES)
+        self.renderTimer = QtCore.QTimer(Form)
+        self.renderTimer.setInterval(1000 // self.FRAME_RATE)
+        self.renderTimer.timeout.connect(self.render)
+        # the watched folder: Qt tells when it changes, the FolderWorker what
+        self.folderWorker = None
+        self.folderThread = None
+        self.polling = False
+        self.pollAgain = False
+        self.watchedImage = None
+        self.fileWatcher = QtCore.QFileSystemWatcher(Form)
+        self.fileWatcher.directoryChanged.connect(self.pollFolder)
+        self.fileWatcher.fileChanged.connect(self.pollFolder)
+        # a build writing an image restarts it at every write
+        self.settleTimer = QtCore.QTimer(Form)
+        self.settleTimer.setSingleShot(True)
+        self.settleTimer.setInterval(int(self.WATCH_SETTLE * 1000) + 100)
+        self.settleTimer.timeout.connect(self.pollFolder)
 
 
     def retranslateUi(self, Form):
@@ -263,12 +372,14 @@ class Ui_Form(QtWidgets.QWidget):
         Form.setWindowTitle(_translate("Form", "Estopa Gui"))
         self.checkBox_SIPFFS.setToolTip(_translate("Form", "<html><head/><body><p>Cochez pour téléverser votre fichier SIPFFS</p></body></html>"))
         self.checkBox_SIPFFS.setText(_translate("Form", " SIPFFS"))
+        self.checkBox_Compression.setToolTip(_translate("Form", "<html><head/><body><p>Cochez pour téléverser le fichier compressé (gzip)</p></body></html>"))
+        self.checkBox_Compression.setText(_translate("Form", " Compresser"))
         self.label_Tx_Chemin.setText(_translate("Form", "Chemin du fichier: "))
         self.label_Chemin.setText(_translate("Form", ""))
         self.pushButton_Fichier.setText(_translate("Form", "Sélection du fichier binaire"))
         self.pushButton_MaJ.setText(_translate("Form", "Mise à jour"))
         self.label_IP_Module.setText(_translate("Form", "Adresse IP Module: "))
-        self.lineEdit_IP_Module.setToolTip(_translate("Form", "<html><head/><body><p>Entrez votre adresse IP:192.168.1.20</p></body></html>"))
+        self.lineEdit_IP_Module.setToolTip(_translate("Form", "<html><head/><body><p>Entrez votre adresse IP:192.168.1.20</p><p>Plusieurs modules: 192.168.1.20, 192.168.1.21</p></body></html>"))
         self.lineEdit_IP_Module.setText(_translate("Form", ""))
         self.label_Port_Module.setText(_translate("Form", "Port Module: "))
         self.lineEdit_Port_Module.setToolTip(_translate("Form", "<html><head/><body><p>Vide=Valeur par défaut ou numéro du port: 8266</p></body></html>"))
@@ -279,20 +390,29 @@ class Ui_Form(QtWidgets.QWidget):
         self.lineEdit_Port_Hote.setText(_translate("Form", ""))
         self.label_MdP.setText(_translate("Form", "Mot de passe: "))
         self.lineEdit_MdP.setToolTip(_translate("Form", "<html><head/><body><p>Vide= Valeur par défaut ou Entrez votre mot de passe</p></body></html>"))
+        self.pushButton_Decouverte.setToolTip(_translate("Form", "<html><head/><body><p>Recherche des modules (mDNS et réseau de l'hôte)</p></body></html>"))
+        self.pushButton_Decouverte.setText(_translate("Form", "Découvrir"))
+        self.pushButton_Suivi.setToolTip(_translate("Form", "<html><head/><body><p>État de chaque module pendant la mise à jour</p></body></html>"))
+        self.pushButton_Suivi.setText(_translate("Form", "Suivi"))
+        self.pushButton_Surveiller.setToolTip(_translate("Form", "<html><head/><body><p>Met à jour les modules avec chaque nouveau fichier binaire d'un dossier</p></body></html>"))
+        self.pushButton_Surveiller.setText(_translate("Form", "Surveiller"))
         self.pushButton_EN.setText(_translate("Form", "English"))
         self.messageBox.setWindowTitle(_translate("Form","Message d'érreur"))
+        self.dashboard.retranslate(False)
 
     def retranslateUi_En(self, Form):
         _translate = QtCore.QCoreApplication.translate
         Form.setWindowTitle(_translate("Form", "Estopa Gui"))
         self.checkBox_SIPFFS.setToolTip(_translate("Form", "<html><head/><body><p>Check to upload your file SIPFFS</p></body></html>"))
         self.checkBox_SIPFFS.setText(_translate("Form", " SIPFFS"))
+        self.checkBox_Compression.setToolTip(_translate("Form", "<html><head/><body><p>Check to upload the file compressed (gzip)</p></body></html>"))
+        self.checkBox_Compression.setText(_translate("Form", " Compress"))
         self.label_Tx_Chemin.setText(_translate("Form", "File path: "))
         self.label_Chemin.setText(_translate("Form", ""))
         self.pushButton_Fichier.setText(_translate("Form", "Selecting the binary file"))
         self.pushButton_MaJ.setText(_translate("Form", "Update"))
         self.label_IP_Module.setText(_translate("Form", "IP address module: "))
-        self.lineEdit_IP_Module.setToolTip(_translate("Form", "<html><head/><body><p>Enter your address IP:192.168.1.20</p></body></html>"))
+        self.lineEdit_IP_Module.setToolTip(_translate("Form", "<html><head/><body><p>Enter your address IP:192.168.1.20</p><p>Several modules: 192.168.1.20, 192.168.1.21</p></body></html>"))
         self.lineEdit_IP_Module.setText(_translate("Form", ""))
         self.label_Port_Module.setText(_translate("Form", "Port Module: "))
         self.lineEdit_Port_Module.setToolTip(_translate("Form", "<html><head/><body><p>Empty = Default value or number of the port: 8266</p></body></html>"))
@@ -303,8 +423,158 @@ class Ui_Form(QtWidgets.QWidget):
         self.lineEdit_Port_Hote.setText(_translate("Form", ""))
         self.label_MdP.setText(_translate("Form", "Password: "))
         self.lineEdit_MdP.setToolTip(_translate("Form", "<html><head/><body><p>Empty= Default value or Enter your password</p></body></html>"))
+        self.pushButton_Decouverte.setToolTip(_translate("Form", "<html><head/><body><p>Look for modules (mDNS and host network)</p></body></html>"))
+        self.pushButton_Decouverte.setText(_translate("Form", "Discover"))
+        self.pushButton_Suivi.setToolTip(_translate("Form", "<html><head/><body><p>State of every module during the update</p></body></html>"))
+        self.pushButton_Suivi.setText(_translate("Form", "Dashboard"))
+        self.pushButton_Surveiller.setToolTip(_translate("Form", "<html><head/><body><p>Update the modules with every new binary file of a folder</p></body></html>"))
+        self.pushButton_Surveiller.setText(_translate("Form", "Watch"))
         self.pushButton_EN.setText(_translate("Form", "French"))
         self.messageBox.setWindowTitle(_translate("Form","Error message"))
+        self.dashboard.retranslate(True)
+
+    def setBusy(self, busy):
+        _translate = QtCore.QCoreApplication.translate
+        english = self.pushButton_EN.text() == "French"
+        if busy:
+            self.pushButton_MaJ.setText(_translate("Form", "Cancel" if english else "Annuler"))
+        else:
+            self.pushButton_MaJ.setText(_translate("Form", "Update" if english else "Mise à jour"))
+        self.pushButton_Fichier.setEnabled(not busy)
+        self.pushButton_Decouverte.setEnabled(not busy)
+
+    def startFlash(self, args, devices=0):
+        self.progressBar.setProperty("value", 0)
+        self.dashboard.clear()
+        # a fleet is followed in the dashboard
+        if devices > 1:
+            self.showDashboard()
+        self.thread = QtCore.QThread()
+        self.worker = FlashWorker(args)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.finished.connect(self.flashFinished)
+        self.setBusy(True)
+        self.thread.start()
+        self.renderTimer.start()
+
+    def render(self):
+        if self.worker is None:
+            return
+        text, dropped, percent = self.worker.reporter.take()
+        if dropped:
+            text = "\n[... %d messages ...]\n" % dropped + text
+        if text:
+            self.textEdit.moveCursor(QtGui.QTextCursor.End)
+            self.textEdit.insertPlainText(text)
+        if percent is not None:
+            self.progressBar.setValue(percent)
+        changes, lines = self.worker.reporter.take_devices()
+        self.dashboard.applyChanges(changes, lines)
+
+    def showDashboard(self):
+        self.dashboard.show()
+        self.dashboard.raise_()
+
+    # watchFolder() : starts or stops watching a folder chosen by the user.
+    def watchFolder(self, checked):
+        english = self.pushButton_EN.text() == "French"
+        if not checked:
+            self.stopWatching()
+            return
+        folder = QFileDialog.getExistingDirectory(self, "Folder of the images" if english else "Dossier des fichiers binaires")
+        if not folder:
+            self.pushButton_Surveiller.setChecked(False)
+            return
+        self.folderThread = QtCore.QThread()
+        self.folderWorker = FolderWorker(folder, self.WATCH_SETTLE)
+        self.folderWorker.moveToThread(self.folderThread)
+        self.folderThread.started.connect(self.folderWorker.start)
+        self.pollRequested.connect(self.folderWorker.poll)
+        self.folderWorker.polled.connect(self.folderPolled)
+        # the images already there are hashed by the worker first
+        self.polling = True
+        self.pollAgain = False
+        self.fileWatcher.addPath(folder)
+        self.folderThread.start()
+        self.textEdit.setText(("Watching " if english else "Surveillance de ") + folder)
+
+    def stopWatching(self):
+        self.settleTimer.stop()
+        if self.fileWatcher.files() or self.fileWatcher.directories():
+            self.fileWatcher.removePaths(self.fileWatcher.files() + self.fileWatcher.directories())
+        if self.folderWorker is not None:
+            self.pollRequested.disconnect(self.folderWorker.poll)
+            self.folderWorker.polled.disconnect(self.folderPolled)
+            self.folderThread.quit()
+            self.folderThread.wait()
+        self.folderWorker = None
+        self.folderThread = None
+        self.watchedImage = None
+
+    # pollFolder() : a change of the watched folder, the worker looks at it;
+    ## a change during its look is looked at after it.
+    def pollFolder(self, path=None):
+        if self.folderWorker is None:
+            return
+        if self.polling:
+            self.pollAgain = True
+            return
+        self.polling = True
+        self.pollRequested.emit()
+
+    # folderPolled() : what the worker found, the images written are sent
+    ## once they settled, the newest only.
+    def folderPolled(self, ready, settling, files):
+        self.polling = False
+        watched = set(self.fileWatcher.files())
+        paths = [path for path in files if path not in watched]
+        if paths:
+            self.fileWatcher.addPaths(paths)
+        if settling:
+            self.settleTimer.start()
+        if ready:
+            self.watchedImage = ready[-1]
+            if self.worker is None:
+                self.flashWatched()
+        if self.pollAgain:
+            self.pollAgain = False
+            self.pollFolder()
+
+    def flashWatched(self):
+        self.label_Chemin.setText(self.watchedImage)
+        self.watchedImage = None
+        CdeFlash()
+
+    def cancelFlash(self):
+        if self.worker is not None:
+            self.worker.reporter.cancel()
+
+    def shutdown(self):
+        self.dashboard.close()
+        self.stopWatching()
+        if self.worker is not None:
+            self.worker.reporter.cancel()
+            self.thread.quit()
+            self.thread.wait()
+
+    def flashFinished(self, result):
+        self.renderTimer.stop()
+        self.render()
+        self.thread.quit()
+        self.thread.wait()
+        self.thread = None
+        self.worker = None
+        self.setBusy(False)
+        if self.discovering:
+            self.discovering = False
+            devices = load_devices()
+            if devices:
+                self.lineEdit_IP_Module.setText(", ".join(device['ip'] if device['port'] == 8266
+                    else "%s:%d" % (device['ip'], device['port']) for device in devices))
+        # an image written during the update
+        if self.watchedImage is not None and self.folderWorker is not None:
+            self.flashWatched()
 
     def setOpenFileName(self):    
         options = QFileDialog.Options()
@@ -314,9 +584,27 @@ class Ui_Form(QtWidgets.QWidget):
                 "Fichier Bin (*.bin)")
         if fileName:
             self.label_Chemin.setText(fileName)
+            self.checkFile(fileName)
+
+    # checkFile() : shows the problems of the headers of the selected image
+    def checkFile(self, fileName):
+        command = SPIFFS if self.checkBox_SIPFFS.isChecked() else FLASH
+        try:
+            image = Image(fileName)
+        except (IOError, OSError) as e:
+            problems = [("ERROR", str(e))]
+        else:
+            try:
+                problems = check_image(image, command)
+            finally:
+                image.close()
+        self.textEdit.setText("\n".join("[%s]: %s" % problem for problem in problems))
 
 
 def CdeFlash():
+    if ui.worker is not None:
+        ui.cancelFlash()
+        return
     ui.textEdit.setText("")
     if ui.label_Chemin.text()=="":
         ui.messageBox.setText("No files selected")
@@ -324,7 +612,11 @@ def CdeFlash():
         ui.messageBox.exec_() 
         return
     try:
-        ip = ipaddress.ip_address(ui.lineEdit_IP_Module.text())
+        targets = parse_targets(ui.lineEdit_IP_Module.text(), 8266)
+        if not targets:
+            raise ValueError(ui.lineEdit_IP_Module.text())
+        for host, port in targets:
+            ip = ipaddress.ip_address(host)
         ui.messageBox.setText("Invalid IP address for module")
     except ValueError:
         if ui.pushButton_EN.text() !="French": ui.messageBox.setText("Adresse IP invalide pour le module")
@@ -334,9 +626,16 @@ def CdeFlash():
         if ui.pushButton_EN.text() !="French": ui.messageBox.setText("Adresse IP invalide pour le module")
         ui.messageBox.exec_()
         return
-    sys.argv=["-i",ui.lineEdit_IP_Module.text(),"-f",ui.label_Chemin.text(),"--auth="+ui.lineEdit_MdP.text(),"-r"]
+    args=["-i",ui.lineEdit_IP_Module.text(),"-f",ui.label_Chemin.text(),"--auth="+ui.lineEdit_MdP.text(),"-r"]
+    # the last update can be replayed with EspotaReplay.py
+    args.append("--trace="+TRACE_FILE)
+    # a fleet skips the modules that are off
+    if len(targets) > 1:
+        args.append("--probe")
     if ui.checkBox_SIPFFS.isChecked()==True:
-        sys.argv.append("-s")
+        args.append("-s")
+    if ui.checkBox_Compression.isChecked()==True:
+        args.append("-z")
     if ui.lineEdit_Port_Module.text()!="":
         validation=checkIntValue(ui.lineEdit_Port_Module.text(),5000,60000)
         if validation=="ko":
@@ -344,7 +643,7 @@ def CdeFlash():
             if ui.pushButton_EN.text() !="French": ui.messageBox.setText("Valeur invalide pour le port du module")
             ui.messageBox.exec_()
             return
-        sys.argv.append("--port="+(ui.lineEdit_Port_Module.text()))
+        args.append("--port="+(ui.lineEdit_Port_Module.text()))
     if ui.lineEdit_Port_Hote.text()!="":
         validation=checkIntValue(ui.lineEdit_Port_Hote.text(),10000,60000)
         if validation=="ko":
@@ -352,7 +651,7 @@ def CdeFlash():
             if ui.pushButton_EN.text() !="French": ui.messageBox.setText("Valeur invalide pour le port de l'hôte")
             ui.messageBox.exec_()
             return
-        sys.argv.append("--host_port="+(ui.lineEdit_Port_Hote.text()))
+        args.append("--host_port="+(ui.lineEdit_Port_Hote.text()))
     if ui.lineEdit_IP_Hote.text()!="":
         try:
             ip = ipaddress.ip_address(ui.lineEdit_IP_Hote.text())
@@ -365,14 +664,29 @@ def CdeFlash():
             if ui.pushButton_EN.text() !="French": ui.messageBox.setText("Adresse IP invalide pour l'hôte")
             ui.messageBox.exec_()
             return
-        sys.argv.append("--host_ip="+(ui.lineEdit_IP_Hote.text()))
-    flashing(sys.argv)
+        args.append("--host_ip="+(ui.lineEdit_IP_Hote.text()))
+    ui.startFlash(args, len(targets))
+
+def CdeDecouverte():
+    if ui.worker is not None:
+        return
+    ui.textEdit.setText("")
+    try:
+        network = str(ipaddress.ip_network(ui.lineEdit_IP_Hote.text() + "/24", strict=False))
+    except ValueError:
+        network = local_network()
+    args = ["--mdns", "--scan", network]
+    if ui.lineEdit_Port_Module.text() != "" and checkIntValue(ui.lineEdit_Port_Module.text(), 5000, 60000) == "ok":
+        args.append("--port=" + ui.lineEdit_Port_Module.text())
+    ui.discovering = True
+    ui.startFlash(args)
 
 def Traduction():
     if ui.pushButton_EN.text()=="English":
         ui.retranslateUi_En(Form)
     else:
         ui.retranslateUi(Form)
+    ui.setBusy(ui.worker is not None)
 
 def checkIntValue(valeur,minValue,maxValue):
     try:
@@ -386,267 +700,386 @@ def checkIntValue(valeur,minValue,maxValue):
     except:
         return ("ko") 
 
-# update_progress() : Displays or updates a console progress bar
-## Accepts a float between 0 and 1. Any int will be converted to a float.
-## A value under 0 represents a 'halt'.
-## A value at 1 or bigger represents 100%
-def update_progress(progress):
-  if (PROGRESS):
-    barLength = 60 # Modify this to change the length of the progress bar
-    status = ""
-    if isinstance(progress, int):
-      progress = float(progress)
-    if not isinstance(progress, float):
-      progress = 0
-      status = "error: progress var must be float\r\n"
-    if progress < 0:
-      progress = 0
-      status = "Halt...\r\n"
-    if progress >= 1:
-      progress = 1
-      status = "Done...\r\n"
-    ui.textEdit.insertPlainText(status)
-    ui.progressBar.setProperty("value", int(progress*100))
-
-  else:
-    ui.textEdit.insertPlainText(".")
-
-def serve(remoteAddr, localAddr, remotePort, localPort, password, filename, command = FLASH):
-  # Create a TCP/IP socket
-  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  server_address = (localAddr, localPort)
-  ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Starting on '+str(server_address[0])+":"+ str(server_address[1]))
-  try:
-    sock.bind(server_address)
-    sock.listen(1)
-  except:
-    ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+"[ERROR]:Listen Failed")
-    return 1
-
-  content_size = os.path.getsize(filename)
-  f = open(filename,'rb')
-  file_md5 = hashlib.md5(f.read()).hexdigest()
-  f.close()
-  ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Upload size: '+str(content_size))
-  message = '%d %d %d %s\n' % (command, localPort, content_size, file_md5)
-
-  # Wait for a connection
-  ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Sending invitation to: '+ remoteAddr)
-  sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-  remote_address = (remoteAddr, int(remotePort))
-  sent = sock2.sendto(message.encode(), remote_address)
-  sock2.settimeout(10)
-  try:
-    data = sock2.recv(128).decode()
-  except:
-    ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No Answer')
-    sock2.close()
-    return 1
-  if (data != "OK"):
-    if(data.startswith('AUTH')):
-      nonce = data.split()[1]
-      cnonce_text = '%s%u%s%s' % (filename, content_size, file_md5, remoteAddr)
-      cnonce = hashlib.md5(cnonce_text.encode()).hexdigest()
-      passmd5 = hashlib.md5(password.encode()).hexdigest()
-      result_text = '%s:%s:%s' % (passmd5 ,nonce, cnonce)
-      result = hashlib.md5(result_text.encode()).hexdigest()
-      ui.textEdit.insertPlainText('Authenticating...')
-      sys.stderr.flush()
-      message = '%d %s %s\n' % (AUTH, cnonce, result)
-      sock2.sendto(message.encode(), remote_address)
-      sock2.settimeout(10)
-      try:
-        data = sock2.recv(32).decode()
-      except:
-        ui.textEdit.insertPlainText('FAIL\n')
-        ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No Answer to our Authentication')
-        sock2.close()
-        return 1
-      if (data != "OK"):
-        ui.textEdit.insertPlainText('FAIL\n')
-        ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: ' + data)
-        sock2.close()
-        return 1
-      ui.textEdit.insertPlainText('OK\n')
-    else:
-      ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Bad Answer: ' + data)
-      sock2.close()
-      return 1
-  sock2.close()
-
-  ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Waiting for device...')
-  try:
-    sock.settimeout(10)
-    connection, client_address = sock.accept()
-    sock.settimeout(None)
-    connection.settimeout(None)
-  except:
-    ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No response from device')
-    sock.close()
-    return 1
-
-  try:
-    f = open(filename, "rb")
-    if (PROGRESS):
-      update_progress(0)
-    else:
-      ui.textEdit.insertPlainText('Uploading')
-      sys.stderr.flush()
-    offset = 0
-    while True:
-      chunk = f.read(1460)
-      if not chunk: break
-      offset += len(chunk)
-      update_progress(offset/float(content_size))
-      connection.settimeout(10)
-      try:
-        connection.sendall(chunk)
-        res = connection.recv(4)
-      except:
-        ui.textEdit.insertPlainText('\n')
-        ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Error Uploading')
-        connection.close()
-        f.close()
-        sock.close()
-        return 1
-
-    ui.textEdit.insertPlainText('\n')
-    ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Waiting for result...')
-    # libraries/ArduinoOTA/ArduinoOTA.cpp L311 L320
-    # only sends digits or 'OK'. We must not not close
-    # the connection before receiving the 'O' of 'OK'
-    try:
-      connection.settimeout(60)
-      while True:
-        if connection.recv(32).decode().find('O') >= 0: break
-      ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Result: OK')
-      connection.close()
-      f.close()
-      sock.close()
-      if (data != "OK"):
-        ui.textEdit.insertPlainText('\n')
-        ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: ' + data)
-        return 1;
-      return 0
-    except:
-      ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No Result!')
-      connection.close()
-      f.close()
-      sock.close()
-      return 1
-
-  finally:
-    connection.close()
-    f.close()
-
-  sock.close()
-  return 1
-# end serve
-
-def parser(unparsed_args):
-  parser = optparse.OptionParser(
-    usage = "%prog [options]",
-    description = "Transmit image over the air to the esp8266 module with OTA support."
-  )
-
-  # destination ip and port
-  group = optparse.OptionGroup(parser, "Destination")
-  group.add_option("-i", "--ip",
-    dest = "esp_ip",
-    action = "store",
-    help = "ESP8266 IP Address.",
-    default = False
-  )
-  group.add_option("-I", "--host_ip",
-    dest = "host_ip",
-    action = "store",
-    help = "Host IP Address.",
-    default = "0.0.0.0"
-  )
-  group.add_option("-p", "--port",
-    dest = "esp_port",
-    type = "int",
-    help = "ESP8266 ota Port. Default 8266",
-    default = 8266
-  )
-  group.add_option("-P", "--host_port",
-    dest = "host_port",
-    type = "int",
-    help = "Host server ota Port. Default random 10000-60000",
-    default = random.randint(10000,60000)
-  )
-  parser.add_option_group(group)
-
-  # auth
-  group = optparse.OptionGroup(parser, "Authentication")
-  group.add_option("-a", "--auth",
-    dest = "auth",
-    help = "Set authentication password.",
-    action = "store",
-    default = ""
-  )
-  parser.add_option_group(group)
-
-  # image
-  group = optparse.OptionGroup(parser, "Image")
-  group.add_option("-f", "--file",
-    dest = "image",
-    help = "Image file.",
-    metavar="FILE",
-    default = None
-  )
-  group.add_option("-s", "--spiffs",
-    dest = "spiffs",
-    action = "store_true",
-    help = "Use this option to transmit a SPIFFS image and do not flash the module.",
-    default = False
-  )
-  parser.add_option_group(group)
-
-  # output group
-  group = optparse.OptionGroup(parser, "Output")
-  group.add_option("-d", "--debug",
-    dest = "debug",
-    help = "Show debug output. And override loglevel with debug.",
-    action = "store_true",
-    default = False
-  )
-  group.add_option("-r", "--progress",
-    dest = "progress",
-    help = "Show progress output. Does not work for ArduinoIDE",
-    action = "store_true",
-    default = False
-  )
-  parser.add_option_group(group)
-
-  (options, args) = parser.parse_args(unparsed_args)
-
-  return options
-# end parser
-
-
-def flashing(args):
- # get options
-  options = parser(args)
-
-  ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+"[DEBUG]: Options: "+str(options))
-
-  # check options
-  global PROGRESS
-  PROGRESS = options.progress
-  if (not options.esp_ip or not options.image):
-    ui.textEdit.insertPlainText((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Not enough arguments.")
-
-    return 1
-  # end if
-
-  command = FLASH
-  if (options.spiffs):
-    command = SPIFFS
-  # end if
-
-  return serve(options.esp_ip, options.host_ip, options.esp_port, options.host_port, options.auth, options.image, command)
-# end main
+
+# DeviceRow : one device of the dashboard, slots keep thousands of rows small.
+class DeviceRow(object):
+    __slots__ = ("device", "phase", "attempt", "sent", "size", "result", "error",
+        "started", "transfer_started", "transfer_ended", "ended", "log")
+
+    def __init__(self, device):
+        self.device = device
+        self.phase = "queued"
+        self.attempt = 0
+        self.sent = 0
+        self.size = 0
+        self.result = None
+        self.error = None
+        self.started = None
+        self.transfer_started = None
+        self.transfer_ended = None
+        self.ended = None
+        # created with the first line only
+        self.log = None
+
+    def state(self):
+        if self.result is not None:
+            return "ok" if self.result == 0 else "failed"
+        if self.phase == "queued":
+            return "queued"
+        return "retry" if self.attempt else "running"
+
+    def update(self, fields):
+        # the phases of a frame are merged, their start times are kept
+        if "bind_time" in fields:
+            # every attempt starts with bind
+            self.result = self.error = self.ended = None
+            self.transfer_started = self.transfer_ended = None
+            self.sent = 0
+            if self.started is None:
+                self.started = fields["bind_time"]
+        if "transfer_time" in fields:
+            self.transfer_started = fields["transfer_time"]
+        if "result_time" in fields:
+            self.transfer_ended = fields["result_time"]
+        if "phase" in fields:
+            self.phase = fields["phase"]
+            self.attempt = fields.get("attempt", self.attempt)
+        if "sent" in fields:
+            self.sent = fields["sent"]
+            self.size = fields["size"]
+        if "result" in fields:
+            self.result = fields["result"]
+            self.error = fields.get("error")
+            self.ended = fields.get("end_time")
+
+    def elapsed(self, now):
+        if self.started is None:
+            return None
+        return (self.ended or now) - self.started
+
+    def rate(self, now):
+        if self.transfer_started is None:
+            return None
+        seconds = (self.transfer_ended or self.ended or now) - self.transfer_started
+        return self.sent / seconds if seconds > 0 else None
+
+
+# DeviceTableModel : the devices of a fleet run for a QTableView.
+## The view only asks for the cells it shows, so the text of a cell is made
+## in data() from the row and thousands of rows cost little. apply() takes
+## the changes of a frame and signals them with one dataChanged() over the
+## rows touched; tick() refreshes the times of the running devices.
+class DeviceTableModel(QtCore.QAbstractTableModel):
+    COLUMNS = ("device", "state", "phase", "sent", "rate", "elapsed", "error")
+    HEADERS = {
+        False: ("Module", "État", "Phase", "Envoyé", "kB/s", "Durée", "Erreur"),
+        True: ("Module", "State", "Phase", "Sent", "kB/s", "Elapsed", "Error"),
+    }
+    STATES = {
+        False: {"queued": "En attente", "running": "En cours", "retry": "Nouvel essai", "ok": "OK", "failed": "Échec"},
+        True: {"queued": "Queued", "running": "Running", "retry": "Retrying", "ok": "OK", "failed": "Failed"},
+    }
+    NUMERIC = (3, 4, 5)
+    MAX_LOG_LINES = 100
+
+    def __init__(self, parent=None):
+        super(DeviceTableModel, self).__init__(parent)
+        self.english = False
+        self.rows = []
+        self.rowOf = {}
+        self.counts = collections.Counter()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[self.english][section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            return self.text(row, self.COLUMNS[column])
+        if role == Qt.TextAlignmentRole and column in self.NUMERIC:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        if role == Qt.ForegroundRole and row.result:
+            return QtGui.QBrush(Qt.red)
+        return None
+
+    def text(self, row, column):
+        now = time.time()
+        if column == "device":
+            return row.device
+        if column == "state":
+            return self.STATES[self.english][row.state()]
+        if column == "phase":
+            return "" if row.phase == "queued" else row.phase
+        if column == "sent":
+            if not row.size:
+                return ""
+            return "%d (%d%%)" % (row.sent, row.sent * 100 // row.size)
+        if column == "rate":
+            rate = row.rate(now)
+            return "" if rate is None else "%.1f" % (rate / 1024)
+        if column == "elapsed":
+            elapsed = row.elapsed(now)
+            return "" if elapsed is None else "%.1f s" % elapsed
+        if column == "error":
+            return row.error or ""
+        return None
+
+    def setEnglish(self, english):
+        self.english = english
+        self.headerDataChanged.emit(Qt.Horizontal, 0, len(self.COLUMNS) - 1)
+        self.refresh(0, len(self.rows) - 1)
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.rowOf = {}
+        self.counts.clear()
+        self.endResetModel()
+
+    def row(self, device):
+        return self.rows[self.rowOf[device]] if device in self.rowOf else None
+
+    def apply(self, changes, lines):
+        added = [device for device in list(changes) + list(lines) if device not in self.rowOf]
+        if added:
+            added = list(collections.OrderedDict.fromkeys(added))
+            self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows) + len(added) - 1)
+            for device in added:
+                self.rowOf[device] = len(self.rows)
+                self.rows.append(DeviceRow(device))
+                self.counts["queued"] += 1
+            self.endInsertRows()
+        first = last = None
+        for device, fields in changes.items():
+            number = self.rowOf[device]
+            row = self.rows[number]
+            self.counts[row.state()] -= 1
+            row.update(fields)
+            self.counts[row.state()] += 1
+            first = number if first is None else min(first, number)
+            last = number if last is None else max(last, number)
+        for device, texts in lines.items():
+            row = self.rows[self.rowOf[device]]
+            if row.log is None:
+                row.log = collections.deque(maxlen=self.MAX_LOG_LINES)
+            row.log.extend(texts)
+        if first is not None:
+            self.refresh(first, last)
+
+    # tick() : the elapsed time and rate of the running devices change with
+    ## the clock only.
+    def tick(self):
+        running = [number for number, row in enumerate(self.rows) if row.started is not None and row.ended is None]
+        if running:
+            self.dataChanged.emit(self.index(running[0], self.COLUMNS.index("rate")),
+                self.index(running[-1], self.COLUMNS.index("elapsed")))
+
+    def refresh(self, first, last):
+        if first <= last:
+            self.dataChanged.emit(self.index(first, 0), self.index(last, len(self.COLUMNS) - 1))
+
+
+# Dashboard : window following every device of a fleet run, with the log of
+## the selected device below the table.
+class Dashboard(QtWidgets.QWidget):
+    TICK = 1.0
+
+    def __init__(self, parent=None):
+        super(Dashboard, self).__init__(parent)
+        self.resize(760, 560)
+        icon = QtGui.QIcon()
+        icon.addPixmap(QtGui.QPixmap("logo-Domo.ico"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        self.setWindowIcon(icon)
+        self.model = DeviceTableModel(self)
+        self.table = QtWidgets.QTableView()
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.table.setWordWrap(False)
+        self.table.verticalHeader().hide()
+        # fixed row heights, the view never measures the rows
+        self.table.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(20)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setColumnWidth(0, 150)
+        self.table.setColumnWidth(3, 120)
+        self.detail = QtWidgets.QPlainTextEdit()
+        self.detail.setReadOnly(True)
+        self.detail.setMaximumBlockCount(DeviceTableModel.MAX_LOG_LINES)
+        self.summary = QtWidgets.QLabel()
+        splitter = QtWidgets.QSplitter(Qt.Vertical)
+        splitter.addWidget(self.table)
+        splitter.addWidget(self.detail)
+        splitter.setSizes([400, 160])
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.summary)
+        layout.addWidget(splitter)
+        self.table.selectionModel().currentRowChanged.connect(self.showDetail)
+        self.selected = None
+        self.ticked = 0.0
+
+    def retranslate(self, english):
+        _translate = QtCore.QCoreApplication.translate
+        self.setWindowTitle(_translate("Form", "Dashboard" if english else "Suivi des modules"))
+        self.model.setEnglish(english)
+        self.showSummary()
+
+    def clear(self):
+        self.model.clear()
+        self.detail.clear()
+        self.selected = None
+        self.showSummary()
+
+    # applyChanges() : the changes and lines of a frame, update() is the
+    ## repaint of QWidget
+    def applyChanges(self, changes, lines):
+        if changes or lines:
+            self.model.apply(changes, lines)
+            if self.selected in lines:
+                for text in lines[self.selected]:
+                    self.detail.appendPlainText(text)
+            self.showSummary()
+        now = time.time()
+        if now - self.ticked >= self.TICK:
+            self.ticked = now
+            self.model.tick()
+
+    def showDetail(self, current, previous):
+        row = self.model.rows[current.row()] if current.isValid() else None
+        self.selected = row.device if row is not None else None
+        self.detail.setPlainText("\n".join(row.log) if row is not None and row.log else "")
+
+    def showSummary(self):
+        counts = self.model.counts
+        states = DeviceTableModel.STATES[self.model.english]
+        self.summary.setText("%d  -  " % len(self.model.rows) + ",  ".join("%s: %d" % (states[state], counts[state])
+            for state in ("queued", "running", "retry", "ok", "failed") if counts[state]))
+
+
+# BufferedReporter : Reporter used by FlashWorker.
+## Text and progress are only stored; the GUI collects them with take() at a
+## fixed frame rate, however often serve() reports. The pending text is a
+## bounded ring, the oldest fragments are dropped if the GUI falls behind.
+## The states of the devices of a fleet are merged per device until
+## take_devices(), so a frame carries one change per device at most.
+class BufferedReporter(Reporter):
+    MAX_PENDING = 1000
+    MAX_DEVICE_LINES = 100
+
+    def __init__(self):
+        super(BufferedReporter, self).__init__()
+        self._lock = threading.Lock()
+        self._pending = collections.deque(maxlen=self.MAX_PENDING)
+        self._dropped = 0
+        self._percent = None
+        self._status = {}
+        self._lines = {}
+
+    def write(self, text):
+        with self._lock:
+            if len(self._pending) == self.MAX_PENDING:
+                self._dropped += 1
+            self._pending.append(text)
+
+    def progress(self, percent):
+        with self._lock:
+            self._percent = percent
+
+    def take(self):
+        with self._lock:
+            text = "".join(self._pending)
+            dropped, percent = self._dropped, self._percent
+            self._pending.clear()
+            self._dropped = 0
+            self._percent = None
+        return text, dropped, percent
+
+    def device_write(self, device, text):
+        with self._lock:
+            lines = self._lines.get(device)
+            if lines is None:
+                lines = self._lines[device] = collections.deque(maxlen=self.MAX_DEVICE_LINES)
+            lines.append(text)
+
+    def device_status(self, device, fields):
+        now = time.time()
+        with self._lock:
+            pending = self._status.get(device)
+            if pending is None:
+                pending = self._status[device] = {}
+            if "phase" in fields:
+                # a new attempt replaces the result of the last one
+                pending.pop("result", None)
+                pending.pop("error", None)
+                pending[fields["phase"] + "_time"] = now
+            if "result" in fields:
+                pending["end_time"] = now
+            pending.update(fields)
+
+    def take_devices(self):
+        with self._lock:
+            changes, lines = self._status, self._lines
+            self._status, self._lines = {}, {}
+        return changes, lines
+
+
+# FolderWorker : the FolderWatcher of the watched folder, in a thread of its
+## own: the images are hashed there, not in the window.
+class FolderWorker(QtCore.QObject):
+    # ready, settling, files
+    polled = QtCore.pyqtSignal(list, bool, list)
+
+    def __init__(self, folder, settle):
+        super(FolderWorker, self).__init__()
+        self.folder = folder
+        self.settle = settle
+        self.watcher = None
+
+    def start(self):
+        try:
+            self.watcher = FolderWatcher(self.folder, "*.bin", self.settle, digest_cache())
+        except OSError:
+            self.watcher = None
+        self.polled.emit([], False, list(self.watcher.files) if self.watcher else [])
+
+    def poll(self):
+        if self.watcher is None:
+            self.polled.emit([], False, [])
+            return
+        try:
+            ready = self.watcher.poll()
+        except OSError:
+            ready = []
+        self.polled.emit(ready, self.watcher.settling(), list(self.watcher.files))
+
+
+class FlashWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal(int)
+
+    def __init__(self, args):
+        super(FlashWorker, self).__init__()
+        self.args = args
+        self.reporter = BufferedReporter()
+
+    def run(self):
+        try:
+            result = flashing(self.args, self.reporter)
+        except Exception as e:
+            self.reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: "+str(e))
+            result = 1
+        self.finished.emit(result)
+
 
 if __name__ == "__main__":
     import sys
@@ -654,6 +1087,7 @@ if __name__ == "__main__":
     Form = QtWidgets.QWidget()
     ui = Ui_Form()
     ui.setupUi(Form)
+    app.aboutToQuit.connect(ui.shutdown)
     Form.show()
     sys.exit(app.exec_())
 
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Replays the sessions of a trace recorded with espota.py --trace (or by
+# EspotaGui, ~/.espota/last.trace) against the espota engine.
+#
+# A local device plays the part of the recorded one: it gives the recorded
+# answers to the invitation and to the authentication, connects back and
+# sends the recorded acks and result, each after the delay it took in the
+# recorded session. An ack is sent once the bytes the host had sent before
+# it are received, then after its recorded lag, so a stall of the device
+# in the field is a stall of the replay. --speed divides the delays; the
+# engine keeps its own timeouts, --speed 1 reproduces them.
+#
+# use it like: python EspotaReplay.py last.trace [--speed 10] [--session 3] [--profile] [--dump]
+
+from __future__ import print_function
+import cProfile
+import json
+import optparse
+import os
+import pstats
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import espota
+from EspotaEmulator import Delayed
+
+
+class QuietReporter(espota.Reporter):
+  def write(self, text):
+    pass
+
+
+# load_sessions() : the sessions of a trace, in order, as dicts with the
+## recorded info and the list of (kind, seconds, a, b, data) events.
+def load_sessions(filename):
+  sessions = {}
+  for kind, number, seconds, a, b, data in espota.read_trace(filename):
+    if kind == espota.TRACE_SESSION:
+      sessions[number] = {'number': number, 'info': json.loads(data.decode()), 'events': []}
+    elif number in sessions:
+      sessions[number]['events'].append((kind, seconds, a, b, data))
+  return [sessions[number] for number in sorted(sessions)]
+
+# script() : what the device does in a session.
+## udp: (lag, answer or None) for every datagram of the host in order;
+## accept: lag from the last answer to the connection, None if the device
+## never connected; acks and results: (bytes sent by the host before it,
+## lag after the last chunk, data).
+def script(session):
+  udp = []
+  accept = None
+  acks = []
+  results = []
+  last = answered = None
+  sent = 0
+  chunk_time = None
+  result = None
+  size = 0
+  for kind, seconds, a, b, data in session['events']:
+    if kind in (espota.TRACE_INVITE, espota.TRACE_AUTH):
+      if kind == espota.TRACE_INVITE:
+        size = int(data.split()[2])
+      udp.append([None, None])
+      last = seconds
+    elif kind in (espota.TRACE_REPLY, espota.TRACE_AUTH_REPLY) and udp:
+      udp[-1] = [seconds - last, data]
+      last = answered = seconds
+    elif kind == espota.TRACE_ACCEPT:
+      accept = seconds - (answered if answered is not None else last)
+    elif kind == espota.TRACE_CHUNK:
+      sent = a + b
+      chunk_time = seconds
+    elif kind == espota.TRACE_ACK:
+      acks.append((sent, seconds - (chunk_time or seconds), data))
+    elif kind == espota.TRACE_RESULT:
+      results.append((sent, seconds - (chunk_time or seconds), data))
+    elif kind == espota.TRACE_END:
+      result = (a, data.decode())
+  return {'udp': udp, 'accept': accept, 'acks': acks, 'results': results, 'size': size, 'result': result}
+
+def duration(session):
+  events = session['events']
+  return events[-1][1] - events[0][1] if events else 0.0
+
+
+# ReplayDevice : answers one session of a trace on ip:port.
+class ReplayDevice(object):
+  def __init__(self, ip, port, steps, speed = 1.0):
+    self.ip = ip
+    self.steps = steps
+    self.speed = speed
+    self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._udp.bind((ip, port))
+    self._udp.settimeout(0.2)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target = self._run)
+    self._thread.daemon = True
+
+  def start(self):
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    self._thread.join()
+    self._udp.close()
+
+  def _sleep(self, seconds):
+    if seconds and seconds > 0:
+      self._stop.wait(seconds / self.speed)
+
+  def _run(self):
+    host_port = None
+    answers = list(self.steps['udp'])
+    # the copies sent after the last answer are not waited for
+    while answers and answers[-1][1] is None:
+      answers.pop()
+    address = None
+    while answers and not self._stop.is_set():
+      try:
+        data, address = self._udp.recvfrom(256)
+      except socket.timeout:
+        continue
+      if host_port is None:
+        host_port = int(data.split()[1])
+        self.host = address[0]
+      lag, answer = answers.pop(0)
+      if answer is not None:
+        self._sleep(lag)
+        self._udp.sendto(answer, address)
+    if self.steps['accept'] is None or not self.steps['udp'] or self._stop.is_set():
+      return
+    self._sleep(self.steps['accept'])
+    try:
+      connection = socket.create_connection((self.host, host_port), timeout = 10, source_address = (self.ip, 0))
+    except socket.error:
+      return
+    self._transfer(connection)
+
+  def _transfer(self, connection):
+    acks = Delayed(connection.sendall)
+    pending = list(self.steps['acks']) + list(self.steps['results'])
+    received = 0
+    try:
+      connection.settimeout(0.2)
+      while pending and not self._stop.is_set():
+        # every ack whose bytes are in
+        while pending and pending[0][0] <= received:
+          sent, lag, data = pending.pop(0)
+          acks.put(lag / self.speed, data)
+        if not pending:
+          break
+        try:
+          data = connection.recv(65536)
+        except socket.timeout:
+          continue
+        if not data:
+          break
+        received += len(data)
+      # the host closes the connection
+      while not self._stop.is_set():
+        try:
+          if not connection.recv(65536):
+            break
+        except socket.timeout:
+          continue
+    except socket.error:
+      pass
+    finally:
+      acks.close()
+      connection.close()
+
+
+# recorded_timeouts() : Timeouts starting from the estimates the recorded
+## session had, which it may have learned from a whole fleet: the timeout
+## of each wait, the time waited for a phase that timed out, and the RTO
+## the datagrams are sent again after.
+def recorded_timeouts(session):
+  info = session['info']
+  estimates = dict(info.get('timeouts', {}))
+  for kind, seconds, a, b, data in session['events']:
+    if kind == espota.TRACE_TIMEOUT:
+      phase = data.decode()
+      estimates['invitation' if phase == 'auth' else phase] = a / 1000.0
+  timeouts = espota.Timeouts()
+  for phase, seconds in estimates.items():
+    estimator = timeouts[phase]
+    estimator.floor = estimator.ceiling = seconds
+    rto = info.get('rto', {}).get(phase)
+    if rto is not None:
+      estimator.srtt = rto
+      estimator.rttvar = 0.0
+  return timeouts
+
+# replay() : plays one session against the engine, returns its result and
+## the time it took.
+def replay(session, options, filename, trace = None):
+  info = session['info']
+  steps = script(session)
+  device = ReplayDevice(options.ip, options.port, steps, options.speed).start()
+  reporter = espota.Reporter() if options.verbose else QuietReporter()
+  started = time.perf_counter()
+  try:
+    result = espota.serve(options.ip, options.host_ip, options.port, random.randint(10000, 60000), 'replay', filename,
+      info.get('command', espota.FLASH), reporter, chunk_size = info.get('chunk_size', 1460),
+      window = info.get('window', 1), sendfile = options.sendfile, check = False, timeouts = recorded_timeouts(session),
+      trace = trace)
+  finally:
+    device.stop()
+  return result, time.perf_counter() - started
+
+def dump(sessions):
+  for session in sessions:
+    print('session %d %s' % (session['number'], json.dumps(session['info'], sort_keys = True)))
+    for kind, seconds, a, b, data in session['events']:
+      print('  %10.6f %-10s %10d %6d %r' % (seconds, espota.TRACE_KINDS.get(kind, kind), a, b, data))
+
+def parser(unparsed_args):
+  parser = optparse.OptionParser(
+    usage = "%prog [options] TRACE",
+    description = "Replay the OTA sessions of a trace against the espota engine."
+  )
+  group = optparse.OptionGroup(parser, "Replay")
+  group.add_option("--session",
+    dest = "session",
+    type = "int",
+    help = "Replay session N only. Default all",
+    metavar = "N",
+    default = None
+  )
+  group.add_option("--speed",
+    dest = "speed",
+    type = "float",
+    help = "Divide the recorded delays by SPEED. Default 1",
+    default = 1.0
+  )
+  group.add_option("-f", "--file",
+    dest = "image",
+    help = "Image to send. Default a blank image of the recorded size",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--no_sendfile",
+    dest = "sendfile",
+    action = "store_false",
+    help = "Send the image from memory instead of with sendfile.",
+    default = True
+  )
+  parser.add_option_group(group)
+  group = optparse.OptionGroup(parser, "Device")
+  group.add_option("-i", "--ip",
+    dest = "ip",
+    help = "Address of the replayed device. Default 127.0.0.2",
+    default = "127.0.0.2"
+  )
+  group.add_option("-p", "--port",
+    dest = "port",
+    type = "int",
+    help = "OTA port of the replayed device. Default 18266",
+    default = 18266
+  )
+  group.add_option("-I", "--host_ip",
+    dest = "host_ip",
+    help = "Host IP Address. Default 127.0.0.1",
+    default = "127.0.0.1"
+  )
+  parser.add_option_group(group)
+  group = optparse.OptionGroup(parser, "Output")
+  group.add_option("--dump",
+    dest = "dump",
+    action = "store_true",
+    help = "Print the events of the trace and exit.",
+    default = False
+  )
+  group.add_option("--profile",
+    dest = "profile",
+    action = "store_true",
+    help = "Profile the engine during the replay.",
+    default = False
+  )
+  group.add_option("--trace",
+    dest = "trace",
+    help = "Record the replayed sessions to FILE.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("-v", "--verbose",
+    dest = "verbose",
+    action = "store_true",
+    help = "Show the output of the engine.",
+    default = False
+  )
+  parser.add_option_group(group)
+  (options, args) = parser.parse_args(unparsed_args)
+  if len(args) != 1:
+    parser.error("one trace file expected")
+  return options, args[0]
+
+def main(args):
+  options, filename = parser(args)
+  try:
+    sessions = load_sessions(filename)
+  except (IOError, OSError, ValueError) as e:
+    print('[CRITICAL]: ' + str(e))
+    return 1
+  if options.session is not None:
+    sessions = [session for session in sessions if session['number'] == options.session]
+  if options.dump:
+    dump(sessions)
+    return 0
+  if options.speed <= 0:
+    print('[CRITICAL]: The speed must be positive.')
+    return 1
+
+  trace = espota.TraceWriter(options.trace) if options.trace else None
+  profile = cProfile.Profile() if options.profile else None
+  folder = tempfile.mkdtemp(prefix = 'espota-replay-')
+  mismatches = 0
+  try:
+    print('session device                 recorded        time s  replayed        time s')
+    for session in sessions:
+      steps = script(session)
+      image = options.image
+      if image is None:
+        image = os.path.join(folder, 'blank-%d.bin' % steps['size'])
+        if not os.path.exists(image):
+          with open(image, 'wb') as f:
+            f.truncate(steps['size'])
+      if profile is not None:
+        profile.enable()
+      result, seconds = replay(session, options, image, trace)
+      if profile is not None:
+        profile.disable()
+      recorded = steps['result'] or (1, 'unknown')
+      replayed = 'ok' if result == 0 else 'failed'
+      if (result == 0) != (recorded[0] == 0):
+        mismatches += 1
+      print('%7d %-22s %-12s %9.3f  %-12s %9.3f' % (session['number'], '%s:%s' % (session['info'].get('device'),
+        session['info'].get('port')), 'ok' if recorded[0] == 0 else recorded[1] or 'failed', duration(session),
+        replayed, seconds))
+      sys.stdout.flush()
+  finally:
+    for name in os.listdir(folder):
+      os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+    if trace is not None:
+      trace.close()
+  if profile is not None:
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+  return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,2895 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Original espota.py by Ivan Grokhotkov:
+# https://gist.github.com/igrr/d35ab8446922179dc58c
+#
+# Modified since 2015-09-18 from Pascal Gollor (https://github.com/pgollor)
+# Modified since 2015-11-09 from Hristo Gochkov (https://github.com/me-no-dev)
+# Modified since 2016-01-03 from Matthew O'Gorman (https://githumb.com/mogorman)
+#
+# This script will push an OTA update to the ESP
+# use it like: python espota.py -i <ESP_IP_address> -I <Host_IP_address> -p <ESP_port> -P <Host_port> [-a password] -f <sketch.bin>
+# Or to upload SPIFFS image:
+# python espota.py -i <ESP_IP_address> -I <Host_IP_address> -p <ESP_port> -P <HOST_port> [-a password] -s -f <spiffs.bin>
+#
+# Changes
+# 2015-09-18:
+# - Add option parser.
+# - Add logging.
+# - Send command to controller to differ between flashing and transmitting SPIFFS image.
+#
+# Changes
+# 2015-11-09:
+# - Added digest authentication
+# - Enhanced error tracking and reporting
+#
+# Changes
+# 2016-01-03:
+# - Added more options to parser.
+#
+# Changes
+# V1.1.0
+# - Engine of EspotaGui, importable and usable from the command line without
+#   Qt (see the changes listed in EspotaGui.py)
+
+from __future__ import print_function
+import array
+import collections
+import csv
+import errno
+import fnmatch
+import socket
+import struct
+import sys
+import os
+import optparse
+import functools
+import gzip
+import ipaddress
+import hashlib
+import json
+import math
+import mmap
+import random
+import select
+import tempfile
+import threading
+import time
+import zlib
+
+# Commands
+FLASH = 0
+SPIFFS = 100
+AUTH = 200
+PROGRESS = False
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".espota", "cache.json")
+DEVICES_FILE = os.path.join(os.path.expanduser("~"), ".espota", "devices.json")
+ROLLOUT_FILE = os.path.join(os.path.expanduser("~"), ".espota", "rollout.json")
+LEDGER_FILE = os.path.join(os.path.expanduser("~"), ".espota", "ledger.jsonl")
+INVENTORY_FILE = os.path.join(os.path.expanduser("~"), ".espota", "inventory.json")
+TRACE_FILE = os.path.join(os.path.expanduser("~"), ".espota", "last.trace")
+PROBE_FILE = os.path.join(os.path.expanduser("~"), ".espota", "probe.json")
+
+
+class Cancelled(Exception):
+  pass
+
+# Reporter : receives everything serve() has to say.
+## The default one writes to stderr; the GUI uses a subclass that forwards to
+## Qt signals so that serve() can run outside of the GUI thread.
+class Reporter(object):
+  def __init__(self):
+    self._cancel = threading.Event()
+    # last percent shown by update_progress()
+    self.shown = None
+    # callables receiving the structured events: listener(kind, fields)
+    self.listeners = []
+    # the last text written left its line open
+    self._open = False
+
+  # write() : every record (a text starting with its time or with a device
+  ## name) is written on a line of its own; the dots and the OK/FAIL of a
+  ## step stay on the line of the step.
+  def write(self, text):
+    record = text.lstrip('\n')
+    if record[:1] == '[' or record[2:3] == ':' and record[8:9] == '[':
+      text = ('\n' if self._open else '') + record.rstrip('\n') + '\n'
+    elif not self._open:
+      text = record
+    if text:
+      self._open = not text.endswith('\n')
+      sys.stderr.write(text)
+      sys.stderr.flush()
+
+  def progress(self, percent):
+    pass
+
+  def event(self, kind, **fields):
+    for listener in self.listeners:
+      listener(kind, fields)
+
+  # device_write() : text of the session of device in a fleet run.
+  def device_write(self, device, text):
+    self.write('\n[%s] %s' % (device, text))
+
+  # device_status() : live state of the session of device ("ip:port"), the
+  ## fields are among phase, attempt, sent, size, result and error. Called
+  ## from the session threads, a dashboard keeps the last value of each.
+  def device_status(self, device, fields):
+    pass
+
+  def cancel(self):
+    self._cancel.set()
+
+  def cancelled(self):
+    return self._cancel.is_set()
+
+  def check(self):
+    if self._cancel.is_set():
+      raise Cancelled()
+
+# SessionReporter : Reporter handed to each serve() of a fleet run.
+## Lines are tagged with the device name, the progress of every device is
+## merged into the fleet progress and a cancel stops the whole fleet.
+class SessionReporter(Reporter):
+  def __init__(self, parent, name, on_progress):
+    Reporter.__init__(self)
+    self._cancel = parent._cancel
+    self.parent = parent
+    self.name = name
+    self.on_progress = on_progress
+
+  def write(self, text):
+    text = text.strip()
+    if text.strip('.'):
+      self.parent.device_write(self.name, text)
+
+  def progress(self, percent):
+    self.on_progress(self.name, percent)
+
+  def event(self, kind, **fields):
+    self.parent.event(kind, **fields)
+
+  def device_status(self, device, fields):
+    self.parent.device_status(device, fields)
+
+# SessionMetrics : timings of one serve() session.
+## begin() starts a phase and ends the previous one; phases are bind, hash,
+## invitation, auth, accept, transfer and result. Every phase end is sent
+## as a 'phase' event and finish() sends the whole session as a 'session'
+## event. Durations use the monotonic perf_counter() clock.
+## fail() records why the session failed, see FAILURES.
+## The phases, the bytes sent (at every percent) and the result are also
+## given to reporter.device_status() under name, "ip:port".
+class SessionMetrics(object):
+  def __init__(self, device, reporter, attempt = 0, name = None):
+    self.device = device
+    self.name = name or device
+    self.reporter = reporter
+    self.attempt = attempt
+    self.error = None
+    self.started = time.time()
+    self.phases = collections.OrderedDict()
+    self.phase = None
+    self.bytes = 0
+    self.rtts = array.array('d')
+    self._mark = None
+    self._percent = None
+    # SessionTrace of the session, see TraceWriter
+    self.trace = None
+
+  def begin(self, phase):
+    now = time.perf_counter()
+    self._end(now)
+    self.phase = phase
+    self._mark = now
+    self.reporter.device_status(self.name, {'phase': phase, 'attempt': self.attempt})
+
+  def progress(self, sent, size):
+    percent = sent * 100 // size if size else 100
+    if percent != self._percent:
+      self._percent = percent
+      self.reporter.device_status(self.name, {'sent': sent, 'size': size})
+
+  def _end(self, now):
+    if self.phase is not None and self._mark is not None:
+      seconds = now - self._mark
+      self.phases[self.phase] = self.phases.get(self.phase, 0.0) + seconds
+      self.reporter.event('phase', device = self.device, phase = self.phase, seconds = seconds)
+      self._mark = None
+
+  def rtt(self, seconds):
+    self.rtts.append(seconds)
+
+  # record() : protocol event of the session for the trace, see TraceWriter.
+  def record(self, kind, a = 0, b = 0, data = b''):
+    if self.trace is not None:
+      self.trace.record(kind, a, b, data)
+
+  def fail(self, error):
+    self.error = error
+    return 1
+
+  def rtt_stats(self):
+    if not self.rtts:
+      return {}
+    ordered = sorted(self.rtts)
+    return {
+      'count': len(ordered),
+      'min': ordered[0],
+      'mean': sum(ordered) / len(ordered),
+      'p50': ordered[len(ordered) // 2],
+      'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+      'max': ordered[-1],
+    }
+
+  def finish(self, result):
+    self._end(time.perf_counter())
+    self.record(TRACE_END, result, 0, (self.error or '').encode())
+    self.reporter.device_status(self.name, {'result': result, 'error': self.error if result else None})
+    transfer = self.phases.get('transfer')
+    self.reporter.event('session',
+      device = self.device,
+      started = self.started,
+      result = result,
+      failed_phase = self.phase if result else None,
+      error = self.error if result else None,
+      attempt = self.attempt,
+      phases = dict(self.phases),
+      bytes = self.bytes,
+      bytes_per_second = self.bytes / transfer if transfer else 0.0,
+      chunk_rtt = self.rtt_stats())
+
+# JsonLinesExporter : Reporter listener writing every event as a JSON line.
+class JsonLinesExporter(object):
+  def __init__(self, filename):
+    self._file = open(filename, 'a')
+    self._lock = threading.Lock()
+
+  def __call__(self, kind, fields):
+    record = dict(fields, event = kind, time = time.time())
+    with self._lock:
+      self._file.write(json.dumps(record, sort_keys = True) + '\n')
+      self._file.flush()
+
+  def close(self):
+    self._file.close()
+
+# PrometheusExporter : Reporter listener keeping the last session of every
+## device, written by save() in the Prometheus text exposition format (for
+## the node_exporter textfile collector).
+class PrometheusExporter(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.sessions = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __call__(self, kind, fields):
+    if kind == 'session':
+      with self._lock:
+        self.sessions[fields['device']] = fields
+
+  def save(self):
+    lines = []
+    def metric(name, kind, text, samples):
+      lines.append('# HELP %s %s' % (name, text))
+      lines.append('# TYPE %s %s' % (name, kind))
+      for labels, value in samples:
+        tags = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+        lines.append('%s{%s} %r' % (name, tags, float(value)))
+    with self._lock:
+      sessions = list(self.sessions.values())
+    metric('espota_session_start_timestamp_seconds', 'gauge', 'Start of the last OTA session.',
+      [((('device', f['device']),), f['started']) for f in sessions])
+    metric('espota_session_result', 'gauge', 'Result of the last OTA session, 0 is success.',
+      [((('device', f['device']),), f['result']) for f in sessions])
+    metric('espota_phase_seconds', 'gauge', 'Duration of each phase of the last OTA session.',
+      [((('device', f['device']), ('phase', phase)), seconds) for f in sessions for phase, seconds in f['phases'].items()])
+    metric('espota_upload_bytes', 'gauge', 'Bytes uploaded in the last OTA session.',
+      [((('device', f['device']),), f['bytes']) for f in sessions])
+    metric('espota_upload_bytes_per_second', 'gauge', 'Transfer rate of the last OTA session.',
+      [((('device', f['device']),), f['bytes_per_second']) for f in sessions])
+    metric('espota_chunk_rtt_seconds', 'gauge', 'Chunk round trip times of the last OTA session.',
+      [((('device', f['device']), ('quantile', q)), f['chunk_rtt'][key])
+        for f in sessions if f['chunk_rtt'] for q, key in (('0', 'min'), ('0.5', 'p50'), ('0.95', 'p95'), ('1', 'max'))])
+    tmp = self.filename + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, self.filename)
+
+  def close(self):
+    self.save()
+
+# Trace records: kind, session, seconds since the start of the trace, two
+## numbers and the length of the data following the record. A trace starts
+## with TRACE_MAGIC.
+TRACE_MAGIC = b'ESPOTRC1'
+TRACE_RECORD = struct.Struct('<BIdIIH')
+TRACE_SESSION = 1     # data: JSON device, port, command, chunk_size, window, attempt, time
+TRACE_INVITE = 2      # a: copies sent before, data: invitation sent
+TRACE_REPLY = 3       # a: copies sent, data: answer to the invitation
+TRACE_AUTH = 4        # a: copies sent before, data: AUTH command and cnonce sent
+TRACE_AUTH_REPLY = 5  # a: copies sent, data: answer to the authentication
+TRACE_TIMEOUT = 6     # a: seconds waited in ms, data: phase
+TRACE_ACCEPT = 7      # the device connected back
+TRACE_CHUNK = 8       # a: offset, b: bytes sent
+TRACE_ACK = 9         # data: ack bytes read
+TRACE_RESULT = 10     # data: result bytes read
+TRACE_END = 11        # a: result, data: error
+TRACE_KINDS = {TRACE_SESSION: 'session', TRACE_INVITE: 'invite', TRACE_REPLY: 'reply', TRACE_AUTH: 'auth',
+  TRACE_AUTH_REPLY: 'auth_reply', TRACE_TIMEOUT: 'timeout', TRACE_ACCEPT: 'accept', TRACE_CHUNK: 'chunk',
+  TRACE_ACK: 'ack', TRACE_RESULT: 'result', TRACE_END: 'end'}
+
+# TraceWriter : records every protocol event of the sessions of a run in a
+## compact binary file, for EspotaReplay.py. Times come from perf_counter().
+## The sessions of a fleet write to the same file; each serve() attempt is
+## a session of its own.
+class TraceWriter(object):
+  def __init__(self, filename):
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+      os.makedirs(folder)
+    self._file = open(filename, 'wb', 65536)
+    self._file.write(TRACE_MAGIC)
+    self._lock = threading.Lock()
+    self._started = time.perf_counter()
+    self._sessions = 0
+
+  def session(self, **info):
+    with self._lock:
+      self._sessions += 1
+      number = self._sessions
+    trace = SessionTrace(self, number)
+    trace.record(TRACE_SESSION, data = json.dumps(dict(info, time = time.time()), sort_keys = True).encode())
+    return trace
+
+  def write(self, kind, session, a, b, data):
+    record = TRACE_RECORD.pack(kind, session, time.perf_counter() - self._started, a, b, len(data))
+    with self._lock:
+      self._file.write(record + data if data else record)
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+class SessionTrace(object):
+  def __init__(self, writer, number):
+    self.writer = writer
+    self.number = number
+
+  def record(self, kind, a = 0, b = 0, data = b''):
+    self.writer.write(kind, self.number, a, b, data[:65535])
+
+# read_trace() : the records of a trace as (kind, session, seconds, a, b, data).
+def read_trace(filename):
+  with open(filename, 'rb') as f:
+    if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+      raise ValueError('%s is not a trace' % filename)
+    while True:
+      header = f.read(TRACE_RECORD.size)
+      if len(header) < TRACE_RECORD.size:
+        # a run killed while writing leaves a partial record
+        return
+      kind, session, seconds, a, b, length = TRACE_RECORD.unpack(header)
+      data = f.read(length)
+      if len(data) < length:
+        return
+      yield kind, session, seconds, a, b, data
+
+# wait_readable() : waits up to timeout seconds for data on sock.
+## The wait is cut in short slices so that a cancel request is honoured
+## quickly. timeout may be a function, read again at every slice, so that
+## the wait follows an RttEstimator learning from other sessions.
+## Raises socket.timeout or Cancelled.
+def wait_readable(sock, timeout, reporter):
+  _wait(sock, timeout, reporter, False)
+
+# wait_writable() : same for room in the send buffer of sock.
+def wait_writable(sock, timeout, reporter):
+  _wait(sock, timeout, reporter, True)
+
+def _wait(sock, timeout, reporter, write):
+  started = time.time()
+  while True:
+    reporter.check()
+    left = started + (timeout() if callable(timeout) else timeout) - time.time()
+    if left <= 0:
+      raise socket.timeout()
+    if _ready(sock, min(left, 0.2), write):
+      return
+
+# _ready() : True when sock is readable (writable with write) within
+## timeout seconds. select() fails on descriptors from 1024 (FD_SETSIZE), a
+## fleet of hundreds of sessions has more, so poll() is used; Windows has
+## no poll() and no such limit.
+if hasattr(select, 'poll'):
+  def _ready(sock, timeout, write = False):
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT if write else select.POLLIN)
+    return bool(poller.poll(int(math.ceil(max(0, timeout) * 1000))))
+else:
+  def _ready(sock, timeout, write = False):
+    if write:
+      return bool(select.select([], [sock], [], max(0, timeout))[1])
+    return bool(select.select([sock], [], [], max(0, timeout))[0])
+
+# DigestCache : image metadata (MD5, ...) keyed by path, size and mtime.
+## Entries live in memory and in a JSON file, so deploying the same build
+## again skips the hashing. A new build of a path replaces the entries of
+## the older ones and the least recently used entries are evicted.
+class DigestCache(object):
+  def __init__(self, filename, max_entries = 32):
+    self.filename = filename
+    self.max_entries = max_entries
+    self._entries = None
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(path, stat):
+    return '%s|%d|%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+  def get(self, key):
+    with self._lock:
+      self._load()
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      self._entries.move_to_end(key)
+      return dict(entry)
+
+  def update(self, key, **values):
+    with self._lock:
+      self._load()
+      path = key.rsplit('|', 2)[0]
+      evicted = [self._entries.pop(k) for k in list(self._entries) if k != key and k.rsplit('|', 2)[0] == path]
+      entry = self._entries.pop(key, {})
+      entry.update(values)
+      self._entries[key] = entry
+      while len(self._entries) > self.max_entries:
+        evicted.append(self._entries.popitem(last = False)[1])
+      self._discard(evicted)
+      self._save()
+
+  def folder(self):
+    return os.path.dirname(self.filename)
+
+  # _discard() : removes the files (compressed images) of evicted entries
+  ## that no remaining entry refers to.
+  def _discard(self, evicted):
+    kept = set(entry.get('gzip') for entry in self._entries.values())
+    for entry in evicted:
+      if entry.get('gzip') and entry['gzip'] not in kept:
+        try:
+          os.remove(entry['gzip'])
+        except (IOError, OSError):
+          pass
+
+  def _load(self):
+    if self._entries is not None:
+      return
+    self._entries = collections.OrderedDict()
+    try:
+      with open(self.filename) as f:
+        for key, entry in json.load(f):
+          self._entries[key] = entry
+    except (IOError, OSError, ValueError, TypeError):
+      pass
+
+  def _save(self):
+    # the cache is only an accelerator, failing to write it is not an error
+    try:
+      folder = self.folder()
+      if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+      tmp = self.filename + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(list(self._entries.items()), f)
+      os.replace(tmp, self.filename)
+    except (IOError, OSError):
+      pass
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# digest_cache() : the DigestCache shared by every run using filename.
+def digest_cache(filename = CACHE_FILE):
+  with _caches_lock:
+    if filename not in _caches:
+      _caches[filename] = DigestCache(filename)
+    return _caches[filename]
+
+# Image : firmware image mapped in memory.
+## The MD5 is computed incrementally over the mapping and the upload chunks
+## are memoryview slices of the same mapping, so the file is never copied
+## into Python memory and one Image can be shared by concurrent sessions.
+class Image(object):
+  HASH_BLOCK = 65536
+
+  def __init__(self, filename, cache = None):
+    self.filename = filename
+    self.cache = cache
+    # removed on close, used for compressed images built without a cache
+    self.temporary = False
+    self._file = open(filename, 'rb')
+    self.stat = os.fstat(self._file.fileno())
+    self.size = self.stat.st_size
+    if self.size:
+      self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+      self.data = memoryview(self._map)
+    else:
+      self._map = None
+      self.data = memoryview(b'')
+    self._md5 = None
+
+  def md5(self):
+    if self._md5 is None and self.cache is not None:
+      entry = self.cache.get(self.cache_key())
+      if entry is not None:
+        self._md5 = entry.get('md5')
+    if self._md5 is None:
+      digest = hashlib.md5()
+      for offset in range(0, self.size, self.HASH_BLOCK):
+        digest.update(self.data[offset:offset + self.HASH_BLOCK])
+      self._md5 = digest.hexdigest()
+      if self.cache is not None:
+        self.cache.update(self.cache_key(), md5 = self._md5)
+    return self._md5
+
+  def cache_key(self):
+    return DigestCache.key(self.filename, self.stat)
+
+  def fileno(self):
+    return self._file.fileno()
+
+  def chunks(self, size):
+    for offset in range(0, self.size, size):
+      yield self.data[offset:offset + size]
+
+  def close(self):
+    self.data.release()
+    if self._map is not None:
+      self._map.close()
+    self._file.close()
+    if self.temporary:
+      os.remove(self.filename)
+
+  def is_gzip(self):
+    return self.data[:2] == b'\x1f\x8b'
+
+# compress_image() : gzip compressed copy of image, as accepted by the
+## ESP8266 Arduino core updater. With a cache the compressed file is kept in
+## the cache folder and reused while the image does not change.
+def compress_image(image, cache = None):
+  entry = cache.get(image.cache_key()) if cache is not None else None
+  if entry and entry.get('gzip') and os.path.isfile(entry['gzip']):
+    packed = Image(entry['gzip'])
+    if packed.size == entry.get('gzip_size'):
+      packed._md5 = entry.get('gzip_md5')
+      return packed
+    packed.close()
+
+  folder = cache.folder() if cache is not None else None
+  if folder and not os.path.isdir(folder):
+    os.makedirs(folder)
+  fd, path = tempfile.mkstemp(suffix = '.bin.gz', dir = folder)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      with gzip.GzipFile(filename = '', mode = 'wb', compresslevel = 9, fileobj = f, mtime = 0) as z:
+        for offset in range(0, image.size, Image.HASH_BLOCK):
+          z.write(image.data[offset:offset + Image.HASH_BLOCK])
+    if cache is not None:
+      final = os.path.join(folder, image.md5() + '.bin.gz')
+      os.replace(path, final)
+      path = final
+  except:
+    os.remove(path)
+    raise
+
+  packed = Image(path)
+  if cache is None:
+    packed.temporary = True
+  else:
+    cache.update(image.cache_key(), gzip = path, gzip_size = packed.size, gzip_md5 = packed.md5())
+  return packed
+
+# Image headers
+## An ESP image starts with the magic byte 0xE9, the number of segments,
+## the flash mode, the flash size (high nibble) and frequency, and the entry
+## point. ESP32 images have 16 more header bytes. Every segment is its load
+## address and length followed by its data.
+ESP_MAGIC = 0xE9
+GZIP_MAGIC = b'\x1f\x8b'
+FLASH_MODES = ('QIO', 'QOUT', 'DIO', 'DOUT')
+ESP8266_FLASH_SIZES = {0: 512 << 10, 1: 256 << 10, 2: 1 << 20, 3: 2 << 20, 4: 4 << 20, 5: 2 << 20, 6: 4 << 20,
+  8: 8 << 20, 9: 16 << 20}
+ESP32_FLASH_SIZES = {0: 1 << 20, 1: 2 << 20, 2: 4 << 20, 3: 8 << 20, 4: 16 << 20, 5: 32 << 20, 6: 64 << 20,
+  7: 128 << 20}
+MAX_SEGMENTS = 16
+FS_BLOCK = 4096
+
+# parse_flash_size() : "512K", "4M" or a number of bytes.
+def parse_flash_size(text):
+  units = {'k': 1 << 10, 'm': 1 << 20}
+  text = text.strip().lower().rstrip('b')
+  if text and text[-1] in units:
+    return int(float(text[:-1]) * units[text[-1]])
+  return int(text)
+
+def _size_text(size):
+  return '%dM' % (size >> 20) if size >= 1 << 20 else '%dK' % (size >> 10)
+
+# check_image() : problems of an image found from its headers, before any
+## network traffic. Returns a list of (level, text), level 'ERROR' when the
+## device would refuse the image, else 'WARNING'. Only the headers are read
+## from the mapping; of a gzip image only the first header is inflated.
+## flash_size is the flash of the devices, by default the one the image was
+## built for.
+def check_image(image, command = FLASH, flash_size = None):
+  data = image.data
+  if image.size == 0:
+    return [('ERROR', 'Empty image')]
+  if command != FLASH:
+    return _check_filesystem(image, flash_size)
+
+  problems = []
+  header = bytes(data[:24])
+  packed = header[:2] == GZIP_MAGIC
+  full_size = image.size
+  if packed:
+    try:
+      header = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(bytes(data[:FS_BLOCK]), 24)
+    except zlib.error as e:
+      return [('ERROR', 'Damaged gzip image: ' + str(e))]
+    # gzip ends with the inflated size
+    full_size = struct.unpack('<I', bytes(data[-4:]))[0] if image.size >= 18 else 0
+  if len(header) < 8:
+    return [('ERROR', 'Truncated image header (%d bytes)' % len(header))]
+  if header[0] != ESP_MAGIC:
+    if bytes(data[8:16]) == b'littlefs':
+      return [('ERROR', 'This is a LittleFS image, upload it as a file system (-s)')]
+    return [('ERROR', 'Not an ESP firmware image (first byte 0x%02x instead of 0x%02x)' % (header[0], ESP_MAGIC))]
+
+  count, mode, size_code = header[1], header[2], header[3] >> 4
+  entry = struct.unpack('<I', header[4:8])[0]
+  esp8266 = 0x40100000 <= entry < 0x40110000
+  if not 1 <= count <= MAX_SEGMENTS:
+    problems.append(('ERROR', 'Invalid segment count %d' % count))
+  if mode >= len(FLASH_MODES):
+    problems.append(('ERROR', 'Invalid flash mode %d' % mode))
+  built = (ESP8266_FLASH_SIZES if esp8266 else ESP32_FLASH_SIZES).get(size_code)
+  if built is None:
+    problems.append(('ERROR', 'Invalid flash size code %d' % size_code))
+
+  if not packed and 1 <= count <= MAX_SEGMENTS:
+    offset = 8 if esp8266 else 24
+    for number in range(count):
+      if offset + 8 > image.size:
+        problems.append(('ERROR', 'Image truncated in the header of segment %d' % number))
+        break
+      address, length = struct.unpack('<II', bytes(data[offset:offset + 8]))
+      offset += 8 + length
+      if offset > image.size:
+        problems.append(('ERROR', 'Segment %d (0x%08x, %d bytes) goes past the end of the image' % (number, address, length)))
+        break
+
+  if flash_size and built and built > flash_size:
+    # the updater refuses an image built for a larger flash
+    problems.append(('ERROR', 'Image built for %s of flash, the devices have %s' % (_size_text(built), _size_text(flash_size))))
+  target = flash_size or built
+  if target and full_size > target:
+    problems.append(('ERROR', 'Image of %d bytes does not fit %s of flash' % (full_size, _size_text(target))))
+  elif target and full_size > target // 2:
+    problems.append(('WARNING', 'Image larger than half of the %s flash, the update also needs room for the running sketch' % _size_text(target)))
+  return problems
+
+def _check_filesystem(image, flash_size):
+  data = image.data
+  problems = []
+  if data[0] == ESP_MAGIC or bytes(data[:2]) == GZIP_MAGIC:
+    return [('ERROR', 'This is a firmware image, not a SPIFFS/LittleFS image')]
+  if image.size % FS_BLOCK:
+    problems.append(('ERROR', 'File system image of %d bytes, not a whole number of %d byte blocks' % (image.size, FS_BLOCK)))
+  # LittleFS keeps its superblock, named "littlefs", in the first two blocks
+  littlefs = bytes(data[8:16]) == b'littlefs' or bytes(data[FS_BLOCK + 8:FS_BLOCK + 16]) == b'littlefs'
+  if not littlefs and bytes(data[:256]).count(b'\xff') == 256:
+    problems.append(('WARNING', 'First page of the SPIFFS image is blank'))
+  if flash_size and image.size > flash_size:
+    problems.append(('ERROR', 'File system image of %d bytes does not fit %s of flash' % (image.size, _size_text(flash_size))))
+  return problems
+
+# image_digest() : MD5 of an image file, from the digest cache if it knows it.
+def image_digest(filename, cache = None):
+  image = Image(filename, cache)
+  try:
+    return image.md5()
+  finally:
+    image.close()
+
+# FolderWatcher : the images a build writes to folder, for --watch and the
+## Watch button. poll() only stats the files: an image is new or changed
+## when its size or mtime is, and ready once they have not moved for settle
+## seconds, the build is done writing it. Only then is it hashed, and it
+## is ready if its digest is not the one already seen for that path. The
+## images in the folder when watching starts are not ready.
+class FolderWatcher(object):
+  def __init__(self, folder, pattern = '*.bin', settle = 2.0, cache = None):
+    self.folder = folder
+    self.pattern = pattern
+    self.settle = settle
+    self.cache = cache
+    # path: [size, mtime_ns, time of the last change or None, digest]
+    self.files = {}
+    for path, stat in self._list():
+      self.files[path] = [stat.st_size, stat.st_mtime_ns, None, self._digest(path)]
+
+  def _list(self):
+    for entry in os.scandir(self.folder):
+      if fnmatch.fnmatch(entry.name, self.pattern):
+        try:
+          if entry.is_file():
+            yield entry.path, entry.stat()
+        except OSError:
+          pass
+
+  def _digest(self, path):
+    try:
+      return image_digest(path, self.cache)
+    except (IOError, OSError, ValueError):
+      return None
+
+  # settling() : whether an image is still being written.
+  def settling(self):
+    return any(entry[2] is not None for entry in self.files.values())
+
+  # poll() : the paths of the images ready, the newest last.
+  def poll(self):
+    now = time.time()
+    seen = set()
+    ready = []
+    for path, stat in self._list():
+      seen.add(path)
+      entry = self.files.get(path)
+      if entry is None:
+        entry = self.files[path] = [None, None, None, None]
+      if (entry[0], entry[1]) != (stat.st_size, stat.st_mtime_ns):
+        entry[0], entry[1], entry[2] = stat.st_size, stat.st_mtime_ns, now
+      elif entry[2] is not None and now - entry[2] >= self.settle:
+        entry[2] = None
+        digest = self._digest(path)
+        if digest is not None and digest != entry[3]:
+          entry[3] = digest
+          ready.append((entry[1], path))
+    for path in set(self.files) - seen:
+      del self.files[path]
+    return [path for mtime, path in sorted(ready)]
+
+# open_image() : opens filename for an upload, compressed if asked to.
+## The image is checked first (see check_image()) unless check is False.
+## Returns None, after reporting why, when the image cannot be used.
+def open_image(filename, cache, compress, command, reporter, check = True, flash_size = None):
+  image = None
+  try:
+    image = Image(filename, cache)
+    if check:
+      problems = check_image(image, command, flash_size)
+      for level, text in problems:
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[%s]: %s' % (level, text))
+      if any(level == 'ERROR' for level, text in problems):
+        image.close()
+        return None
+    if compress:
+      if command != FLASH:
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[WARNING]: Compression is only supported when flashing, sending the raw image')
+      elif not image.is_gzip():
+        packed = compress_image(image, cache)
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Compressed %d bytes to %d bytes' % (image.size, packed.size))
+        image.close()
+        image = packed
+    image.md5()
+    return image
+  except (IOError, OSError, ValueError) as e:
+    if image is not None:
+      image.close()
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Cannot read image: '+str(e))
+    return None
+
+# update_progress() : Displays or updates a console progress bar
+## Accepts a float between 0 and 1. Any int will be converted to a float.
+## A value under 0 represents a 'halt'.
+## A value at 1 or bigger represents 100%
+## Nothing is output until the percentage changes, so the output does not
+## grow with the size of the image.
+def update_progress(progress, reporter):
+  percent = int(progress*100) if isinstance(progress, (int, float)) else None
+  if percent is not None and 0 <= percent < 100 and percent == reporter.shown:
+    return
+  reporter.shown = percent
+  if (PROGRESS):
+    barLength = 60 # Modify this to change the length of the progress bar
+    status = ""
+    if isinstance(progress, int):
+      progress = float(progress)
+    if not isinstance(progress, float):
+      progress = 0
+      status = "error: progress var must be float\r\n"
+    if progress < 0:
+      progress = 0
+      status = "Halt...\r\n"
+    if progress >= 1:
+      progress = 1
+      status = "Done...\r\n"
+    reporter.write(status)
+    reporter.progress(int(progress*100))
+
+  else:
+    reporter.write(".")
+
+# _upload() : sends the image over the device connection.
+## With window = 1 every chunk waits for its ack (lock-step, as espota.py).
+## With a larger window up to window chunks are in flight and the acks are
+## drained as they come. ArduinoOTA acks with the number of bytes it wrote,
+## in ASCII; acks read together are split by _read_ack().
+## A throttle(count, reporter) function (the tokens of the Governor) is
+## called before every send, before its time is taken: the wait is not
+## part of the round trip.
+## Returns True when the 'O' of the final 'OK' was already received.
+def _upload(connection, image, chunk_size, window, reporter, metrics, sendfile = True, estimator = None, throttle = None):
+  content_size = image.size
+  send = _sender(connection, image, reporter, sendfile)
+  if estimator is None:
+    estimator = RttEstimator()
+  offset = 0
+  # the 'O' of the final 'OK' may arrive together with the last ack
+  result_ok = False
+  # a full send buffer is not a lost ack, it may block up to the ceiling
+  connection.settimeout(estimator.ceiling)
+  if window <= 1:
+    while offset < content_size:
+      reporter.check()
+      length = min(chunk_size, content_size - offset)
+      if throttle is not None:
+        throttle(length, reporter)
+      sent = time.perf_counter()
+      send(offset, length)
+      metrics.record(TRACE_CHUNK, offset, length)
+      offset += length
+      update_progress(offset/float(content_size), reporter)
+      metrics.progress(offset, content_size)
+      wait_readable(connection, estimator.timeout, reporter)
+      res = connection.recv(4)
+      metrics.record(TRACE_ACK, data = res)
+      estimator.sample(time.perf_counter() - sent)
+      metrics.rtt(time.perf_counter() - sent)
+      metrics.bytes = offset
+      result_ok = result_ok or b'O' in res
+    return result_ok
+
+  limit = chunk_size * window
+  # (size, send time) of the chunks in flight, oldest first
+  in_flight = collections.deque()
+  # digits and bytes of the last ack, see _read_ack()
+  tail = [b'', 0]
+
+  # the acks that come while the throttle waits are timed when they come
+  def wait(seconds):
+    nonlocal result_ok
+    if not in_flight:
+      time.sleep(seconds)
+    elif _ready(connection, seconds):
+      result_ok = _read_ack(connection, in_flight, metrics, estimator, chunk_size, tail) or result_ok
+  while offset < content_size:
+    reporter.check()
+    length = min(chunk_size, content_size - offset)
+    while in_flight and _flight_size(in_flight) + length > limit:
+      wait_readable(connection, estimator.timeout, reporter)
+      result_ok = _read_ack(connection, in_flight, metrics, estimator, chunk_size, tail) or result_ok
+    # every chunk the window has room for goes in one send
+    room = max(1, (limit - _flight_size(in_flight)) // chunk_size) * chunk_size
+    count = min(room, content_size - offset)
+    if throttle is not None:
+      throttle(count, reporter, wait)
+    now = time.perf_counter()
+    for start in range(offset, offset + count, chunk_size):
+      in_flight.append([min(chunk_size, offset + count - start), now])
+    send(offset, count)
+    metrics.record(TRACE_CHUNK, offset, count)
+    offset += count
+    metrics.bytes = offset
+    update_progress(offset/float(content_size), reporter)
+    metrics.progress(offset, content_size)
+    while in_flight and _ready(connection, 0):
+      result_ok = _read_ack(connection, in_flight, metrics, estimator, chunk_size, tail) or result_ok
+  return result_ok
+
+# _sender() : returns send(offset, count), sending a range of the image.
+## os.sendfile() moves the range from the page cache to the socket without
+## copying it through Python. Where it is missing (Windows) or refused for
+## this file or socket, the mapped memory is sent with sendall().
+def _sender(connection, image, reporter, sendfile = True):
+  use_sendfile = sendfile and hasattr(os, 'sendfile')
+
+  def send(offset, count):
+    nonlocal use_sendfile
+    if use_sendfile:
+      done = _sendfile(connection, image.fileno(), offset, count, reporter)
+      if done == offset + count:
+        return
+      use_sendfile = False
+      count -= done - offset
+      offset = done
+    connection.sendall(image.data[offset:offset + count])
+  return send
+
+# _sendfile() : sends count bytes of fd from offset with os.sendfile().
+## The offset is explicit, so the sessions of a fleet can share the file.
+## Returns the offset reached, short of the end if sendfile is refused.
+def _sendfile(connection, fd, offset, count, reporter):
+  end = offset + count
+  while offset < end:
+    try:
+      sent = os.sendfile(connection.fileno(), fd, offset, end - offset)
+    except (BlockingIOError, InterruptedError):
+      wait_writable(connection, connection.gettimeout() or 10, reporter)
+      continue
+    except OSError as e:
+      if e.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP):
+        return offset
+      raise
+    if sent == 0:
+      raise socket.error('image file truncated')
+    offset += sent
+  return offset
+
+def _flight_size(in_flight):
+  return sum(entry[0] for entry in in_flight)
+
+# ArduinoOTA writes at most one TCP segment per read, so it acks at most
+## this or a chunk
+DEVICE_READ = 1460
+
+# _split_acks() : the acks in digits, acks read together ("14601460") are
+## split into numbers of at most largest bytes without leading zeros, the
+## longest first. A short number is taken whole, a device writing a stream
+## acks more than a read. None when digits cannot be split so within flight.
+def _split_acks(digits, largest, flight):
+  if not digits.isdigit():
+    return None
+  if digits[:1] != b'0' and len(digits) <= len(str(largest)) + 1 and int(digits) <= flight:
+    return [int(digits)]
+  splits = {len(digits): []}
+
+  def split(start):
+    if start not in splits:
+      splits[start] = None
+      if digits[start:start + 1] != b'0':
+        for end in range(min(len(digits), start + len(str(largest))), start, -1):
+          if int(digits[start:end]) <= largest and split(end) is not None:
+            splits[start] = [int(digits[start:end])] + splits[end]
+            break
+    return splits[start]
+  acks = split(0)
+  return acks if acks is not None and sum(acks) <= flight else None
+
+# _read_ack() : reads acks and removes the acknowledged bytes from in_flight.
+## A read may end in the middle of an ack ("146", then "0"): tail keeps the
+## digits of the last ack read and the bytes they acknowledged, the next
+## read is parsed after them and only the difference is acknowledged. Digits
+## that cannot be split acknowledge nothing, only the final 'OK' (the device
+## wrote everything) acknowledges all the bytes in flight.
+## Returns True when the 'O' of 'OK' was read.
+def _read_ack(connection, in_flight, metrics, estimator, chunk_size, tail):
+  res = connection.recv(64)
+  metrics.record(TRACE_ACK, data = res)
+  if not res:
+    raise socket.error('connection closed')
+  ok = b'O' in res
+  digits = res.split(b'O')[0]
+  flight = _flight_size(in_flight)
+  largest = max(chunk_size, DEVICE_READ)
+  acked = 0
+  if digits:
+    acks = _split_acks(tail[0] + digits, largest, flight + tail[1])
+    credited = tail[1]
+    if acks is None and tail[0]:
+      # the last ack was whole
+      acks = _split_acks(digits, largest, flight)
+      credited = 0
+    if acks is None:
+      tail[:] = [b'', 0]
+    else:
+      acked = sum(acks) - credited
+      tail[:] = [str(acks[-1]).encode(), acks[-1]]
+  if ok:
+    acked = flight
+    tail[:] = [b'', 0]
+  now = time.perf_counter()
+  while acked > 0 and in_flight:
+    entry = in_flight[0]
+    if entry[0] > acked:
+      entry[0] -= acked
+      break
+    acked -= entry[0]
+    estimator.sample(now - entry[1])
+    metrics.rtt(now - entry[1])
+    in_flight.popleft()
+  return ok
+
+# RttEstimator : timeout of a wait derived from the measured round trips.
+## As TCP does (RFC 6298): a smoothed RTT and an RTT variation are updated
+## by every sample and the timeout is srtt + 4 * rttvar, kept between floor
+## and ceiling. Before the first sample the estimate of the parent (the
+## fleet) is used, or the ceiling without one. Each missed() doubles the
+## timeout until the next sample.
+class RttEstimator(object):
+  def __init__(self, floor = 1.0, ceiling = 10.0, parent = None):
+    self.floor = floor
+    self.ceiling = ceiling
+    self.parent = parent
+    self.srtt = None
+    self.rttvar = None
+    self._backoff = 1
+    self._lock = threading.Lock()
+
+  def sample(self, rtt):
+    with self._lock:
+      if self.srtt is None:
+        self.srtt = rtt
+        self.rttvar = rtt / 2
+      else:
+        self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+        self.srtt = 0.875 * self.srtt + 0.125 * rtt
+      self._backoff = 1
+    if self.parent is not None:
+      self.parent.sample(rtt)
+
+  def missed(self):
+    with self._lock:
+      self._backoff = min(self._backoff * 2, 64)
+
+  # rto() : srtt + 4 * rttvar of the samples, or of the parent without
+  ## any, without the floor and the backoff; None before any sample.
+  def rto(self):
+    if self.srtt is not None:
+      return self.srtt + 4 * self.rttvar
+    if self.parent is not None:
+      return self.parent.rto()
+    return None
+
+  def timeout(self):
+    if self.srtt is not None:
+      timeout = self.srtt + 4 * self.rttvar
+    elif self.parent is not None:
+      timeout = self.parent.timeout()
+    else:
+      timeout = self.ceiling
+    return min(self.ceiling, max(self.floor, timeout) * self._backoff)
+
+# Timeouts : the estimators of the waits of a session, or of a fleet when
+## they are the parent of the session ones. The answer to the invitation
+## (and to the authentication), the connection of the device, every chunk
+## ack and the result are estimated separately. The result comes after the
+## device checked the whole image, it may wait RESULT_FACTOR times longer.
+class Timeouts(object):
+  PHASES = ('invitation', 'accept', 'chunk', 'result')
+  RESULT_FACTOR = 6
+
+  def __init__(self, floor = 1.0, ceiling = 10.0, parent = None):
+    self.floor = floor
+    self.ceiling = ceiling
+    self.estimators = {}
+    for phase in self.PHASES:
+      self.estimators[phase] = RttEstimator(floor, ceiling * (self.RESULT_FACTOR if phase == 'result' else 1),
+        parent[phase] if parent is not None else None)
+
+  def __getitem__(self, phase):
+    return self.estimators[phase]
+
+  # session() : Timeouts of a session of the fleet, starting from its estimates.
+  def session(self):
+    return Timeouts(self.floor, self.ceiling, self)
+
+# TokenBucket : byte rate limit shared by the sessions of a fleet.
+## take() reserves the bytes at once, even beyond the tokens available, and
+## sleeps until the bucket has refilled: the reservations are served in the
+## order they were made, so sessions drawing chunk by chunk alternate fairly.
+class TokenBucket(object):
+  def __init__(self, rate, burst = None):
+    self.rate = float(rate)
+    # 100 ms of traffic by default
+    self.burst = float(burst) if burst else max(self.rate / 10, 1460.0)
+    self._tokens = self.burst
+    self._stamp = time.perf_counter()
+    self._lock = threading.Lock()
+
+  def reserve(self, count):
+    with self._lock:
+      now = time.perf_counter()
+      self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+      self._stamp = now
+      self._tokens -= count
+      return max(0.0, -self._tokens / self.rate)
+
+# Governor : total byte rate of the uploads and rate of each group of
+## devices (the devices of a subnet, behind the same access point). Either
+## limit may be None. throttle(remoteAddr) returns the function a session
+## calls with the size of every send; it waits with wait(seconds), which
+## may read the acks meanwhile.
+class Governor(object):
+  def __init__(self, rate = None, group_rate = None, prefix = 24, groups = None):
+    self.total = TokenBucket(rate) if rate else None
+    self.group_rate = group_rate
+    self.prefix = prefix
+    # explicit group of an address, before its subnet
+    self.groups = groups or {}
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def group(self, remoteAddr):
+    if remoteAddr in self.groups:
+      return self.groups[remoteAddr]
+    try:
+      return str(ipaddress.ip_network('%s/%d' % (remoteAddr, self.prefix), strict = False))
+    except ValueError:
+      return remoteAddr
+
+  def buckets(self, remoteAddr):
+    buckets = [self.total] if self.total is not None else []
+    if self.group_rate:
+      name = self.group(remoteAddr)
+      with self._lock:
+        if name not in self._buckets:
+          self._buckets[name] = TokenBucket(self.group_rate)
+        buckets.append(self._buckets[name])
+    return buckets
+
+  def throttle(self, remoteAddr):
+    buckets = self.buckets(remoteAddr)
+    def take(count, reporter, wait = time.sleep):
+      delay = max([bucket.reserve(count) for bucket in buckets] or [0.0])
+      deadline = time.perf_counter() + delay
+      while True:
+        reporter.check()
+        left = deadline - time.perf_counter()
+        if left <= 0:
+          return
+        wait(min(left, 0.2))
+    return take
+
+# Failures of a session, transient ones are worth retrying: the device did
+## not answer or the Wi-Fi dropped the transfer. A permanent failure fails
+## the same way again (wrong password, not an OTA device, bad image).
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+FAILURES = {
+  'listen': TRANSIENT,
+  'image': PERMANENT,
+  'no_answer': TRANSIENT,
+  'auth_no_answer': TRANSIENT,
+  'auth_rejected': PERMANENT,
+  'bad_answer': PERMANENT,
+  'no_response': TRANSIENT,
+  'upload': TRANSIENT,
+  'no_result': TRANSIENT,
+  'cancelled': PERMANENT,
+  'unreachable': TRANSIENT,
+}
+
+# RetryPolicy : how often and when a failed session is tried again.
+## Only transient failures are retried, after an exponential backoff with
+## jitter (half of the delay is random) so that the devices of a fleet
+## failing together do not retry in lock-step.
+class RetryPolicy(object):
+  def __init__(self, retries = 2, delay = 1.0, factor = 2.0, max_delay = 30.0):
+    self.retries = retries
+    self.delay = delay
+    self.factor = factor
+    self.max_delay = max_delay
+
+  def should_retry(self, error, attempt):
+    return attempt < self.retries and FAILURES.get(error) == TRANSIENT
+
+  def backoff(self, attempt):
+    delay = min(self.max_delay, self.delay * self.factor ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# SharedListener : one listening socket for the connect-backs of a whole
+## fleet, so that every device uses the same host port (one firewall rule).
+## A session calls expect() before sending its invitation and the accept
+## thread routes the connections to the sessions by device address. Two
+## sessions for the same address get the connections in invitation order,
+## harmless as a fleet sends the same image to all its devices.
+class SharedListener(object):
+  def __init__(self, localAddr, localPort, reporter = None):
+    self.port = localPort
+    self.reporter = reporter or Reporter()
+    self._routes = {}
+    self._cond = threading.Condition()
+    self._stop = threading.Event()
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+      self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+      self._sock.bind((localAddr, localPort))
+      self._sock.listen(64)
+    except socket.error:
+      self._sock.close()
+      raise
+    self._thread = threading.Thread(target = self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def expect(self, remoteAddr):
+    route = _Route(self, remoteAddr)
+    with self._cond:
+      self._routes.setdefault(remoteAddr, collections.deque()).append(route)
+    return route
+
+  def _remove(self, route):
+    with self._cond:
+      routes = self._routes.get(route.address)
+      if routes and route in routes:
+        routes.remove(route)
+        if not routes:
+          del self._routes[route.address]
+
+  def _run(self):
+    while not self._stop.is_set():
+      if not _ready(self._sock, 0.2):
+        continue
+      try:
+        connection, address = self._sock.accept()
+      except socket.error:
+        continue
+      with self._cond:
+        routes = self._routes.get(address[0])
+        route = routes.popleft() if routes else None
+        if routes is not None and not routes:
+          del self._routes[address[0]]
+        if route is not None:
+          route.connection = (connection, address)
+          self._cond.notify_all()
+      if route is None:
+        self.reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+'[WARNING]: Unexpected connection from '+address[0])
+        connection.close()
+
+  def close(self):
+    self._stop.set()
+    self._thread.join()
+    self._sock.close()
+
+# _Route : the connect-back a session is waiting for on a SharedListener.
+class _Route(object):
+  def __init__(self, listener, address):
+    self.listener = listener
+    self.address = address
+    self.connection = None
+    self.taken = False
+
+  def accept(self, timeout, reporter):
+    started = time.time()
+    with self.listener._cond:
+      while self.connection is None:
+        reporter.check()
+        left = started + (timeout() if callable(timeout) else timeout) - time.time()
+        if left <= 0:
+          raise socket.timeout()
+        self.listener._cond.wait(min(left, 0.2))
+      self.taken = True
+      return self.connection
+
+  def close(self):
+    self.listener._remove(self)
+    with self.listener._cond:
+      if self.connection is not None and not self.taken:
+        self.connection[0].close()
+
+# First interval before a datagram is sent again: the RTO of the device,
+## at least RETRANSMIT_MIN, or RETRANSMIT_FIRST before any round trip.
+RETRANSMIT_MIN = 0.25
+RETRANSMIT_FIRST = 0.5
+# New nonces answered in one authentication, see _serve()
+MAX_NONCES = 4
+
+# _connected() : True when the device is connecting back already; its OK
+## was lost on the way.
+def _connected(sock):
+  if isinstance(sock, _Route):
+    return sock.connection is not None
+  return _ready(sock, 0)
+
+# _exchange() : sends message to the device and returns its answer.
+## The message is sent again at growing intervals (doubled every time)
+## until the answer comes or the timeout of the estimator runs out, so a
+## lost datagram costs one interval instead of the whole timeout. Answers
+## from other addresses and the duplicates for which duplicate(data) is
+## True are dropped. An answer may answer any of the copies sent, so only
+## an exchange sent once gives an RTT sample (Karn's rule). shown is what
+## the trace records of the message. again, when given, follows every copy
+## of message; interval replaces the first interval of the estimator.
+## Returns None when the device connects back without its answer reaching
+## us (connected()), and raises socket.timeout.
+def _exchange(sock2, message, remote_address, estimator, reporter, metrics, kinds, connected, shown = None,
+    duplicate = None, again = None, interval = None):
+  sent_kind, reply_kind = kinds
+  if interval is None:
+    rto = estimator.rto()
+    interval = max(RETRANSMIT_MIN, rto) if rto is not None else RETRANSMIT_FIRST
+  started = time.perf_counter()
+  sends = 0
+  next_send = started
+  while True:
+    reporter.check()
+    now = time.perf_counter()
+    # read again, the estimate follows the other sessions of the fleet
+    deadline = started + estimator.timeout()
+    if now >= deadline:
+      raise socket.timeout()
+    if now >= next_send:
+      sock2.sendto(message, remote_address)
+      metrics.record(sent_kind, sends, data = shown or message)
+      if sends:
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: No answer, sent again (%d)' % sends)
+        if again is not None:
+          sock2.sendto(again, remote_address)
+          metrics.record(TRACE_INVITE, sends, data = again)
+      sends += 1
+      next_send = now + interval
+      interval *= 2
+    if not _ready(sock2, min(next_send, deadline, now + 0.2) - now):
+      if connected():
+        return None
+      continue
+    data, address = sock2.recvfrom(128)
+    metrics.record(reply_kind, sends, data = data)
+    if address[0] != remote_address[0] or (duplicate is not None and duplicate(data)):
+      continue
+    if sends == 1:
+      estimator.sample(time.perf_counter() - started)
+    return data
+
+def serve(remoteAddr, localAddr, remotePort, localPort, password, filename, command = FLASH, reporter = None,
+    chunk_size = 1460, window = 1, cache = None, compress = False, retry = None, listener = None, sendfile = True,
+    timeouts = None, governor = None, check = True, flash_size = None, trace = None):
+  if reporter is None:
+    reporter = Reporter()
+  # kept across the attempts, a retry waits longer after a timeout
+  if timeouts is None:
+    timeouts = Timeouts()
+  attempt = 0
+  while True:
+    metrics = SessionMetrics(remoteAddr, reporter, attempt, '%s:%d' % (remoteAddr, remotePort))
+    if trace is not None:
+      metrics.trace = trace.session(device = remoteAddr, port = remotePort, command = command, chunk_size = chunk_size,
+        window = window, attempt = attempt, timeouts = dict((phase, timeouts[phase].timeout()) for phase in Timeouts.PHASES),
+        rto = dict((phase, timeouts[phase].rto()) for phase in Timeouts.PHASES))
+    result = 1
+    try:
+      result = _bind_and_serve(remoteAddr, localAddr, remotePort, localPort, password, filename, command, reporter,
+        chunk_size, window, cache, compress, metrics, listener, sendfile, timeouts, governor, check, flash_size)
+    finally:
+      metrics.finish(result)
+    if result == 0 or retry is None or not retry.should_retry(metrics.error, attempt):
+      if result and retry is not None and metrics.error not in (None, 'cancelled'):
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Failed (%s, %s), %d attempt(s)' % (metrics.error, FAILURES[metrics.error], attempt + 1))
+      return result
+    delay = retry.backoff(attempt)
+    attempt += 1
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Retry %d/%d in %.1f s' % (attempt, retry.retries, delay))
+    if reporter._cancel.wait(delay):
+      return result
+
+def _bind_and_serve(remoteAddr, localAddr, remotePort, localPort, password, filename, command, reporter,
+    chunk_size, window, cache, compress, metrics, listener = None, sendfile = True, timeouts = None, governor = None,
+    check = True, flash_size = None):
+  metrics.begin('bind')
+  if listener is not None:
+    # the device connects back to the port shared by the fleet
+    sock = listener.expect(remoteAddr)
+    localPort = listener.port
+  else:
+    # Create a TCP/IP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # a retry listens again on the port of the previous attempt; on Windows
+    ## SO_REUSEADDR would let another program steal the port
+    if os.name != 'nt':
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_address = (localAddr, localPort)
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Starting on '+str(server_address[0])+":"+ str(server_address[1]))
+    try:
+      sock.bind(server_address)
+      sock.listen(1)
+    except:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[ERROR]:Listen Failed")
+      sock.close()
+      return metrics.fail('listen')
+
+  # a fleet run passes one Image shared by all its sessions
+  image = filename
+  if not isinstance(image, Image):
+    metrics.begin('hash')
+    image = open_image(filename, cache, compress, command, reporter, check, flash_size)
+    if image is None:
+      sock.close()
+      return metrics.fail('image')
+
+  try:
+    return _serve(sock, remoteAddr, localPort, remotePort, password, image, command, reporter, chunk_size, window, metrics,
+      sendfile, timeouts or Timeouts(), governor)
+  except Cancelled:
+    reporter.write('\n')
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Cancelled')
+    return metrics.fail('cancelled')
+  finally:
+    sock.close()
+    if image is not filename:
+      image.close()
+
+def _serve(sock, remoteAddr, localPort, remotePort, password, image, command, reporter, chunk_size, window, metrics,
+    sendfile, timeouts, governor = None):
+  content_size = image.size
+  file_md5 = image.md5()
+  reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Upload size: '+str(content_size))
+  message = '%d %d %d %s\n' % (command, localPort, content_size, file_md5)
+  invitation_message = message.encode()
+
+  # Wait for a connection
+  metrics.begin('invitation')
+  reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Sending invitation to: '+ remoteAddr)
+  sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    remote_address = (remoteAddr, int(remotePort))
+    invitation = timeouts['invitation']
+    started = time.perf_counter()
+    try:
+      data = _exchange(sock2, message.encode(), remote_address, invitation, reporter, metrics, (TRACE_INVITE, TRACE_REPLY),
+        lambda: _connected(sock))
+      if data is None:
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Device connecting, its answer was lost')
+        data = b'OK'
+      data = data.decode()
+    except (socket.error, ValueError):
+      metrics.record(TRACE_TIMEOUT, int((time.perf_counter() - started) * 1000), data = b'invitation')
+      invitation.missed()
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No Answer')
+      return metrics.fail('no_answer')
+    if (data != "OK"):
+      if(data.startswith('AUTH')):
+        metrics.begin('auth')
+        # a round trip takes at most the time the invitation was answered in
+        waited = time.perf_counter() - started
+        nonce = data.split()[1]
+        nonces = set()
+        cnonce_text = '%s%u%s%s' % (image.filename, content_size, file_md5, remoteAddr)
+        cnonce = hashlib.md5(cnonce_text.encode()).hexdigest()
+        passmd5 = hashlib.md5(password.encode()).hexdigest()
+        reporter.write('Authenticating...')
+        started = time.perf_counter()
+        try:
+          # A copy of the invitation received while the device waits for
+          ## our answer cancels its authentication (ArduinoOTA), it then
+          ## ignores the answer. Every copy of the answer is followed by the
+          ## invitation, the device makes a new nonce when it is idle and
+          ## the new nonce is answered; the answers to the nonces already
+          ## answered are dropped.
+          while True:
+            nonces.add(nonce)
+            result_text = '%s:%s:%s' % (passmd5 ,nonce, cnonce)
+            result = hashlib.md5(result_text.encode()).hexdigest()
+            message = '%d %s %s\n' % (AUTH, cnonce, result)
+            # without the response: with the nonce it would let the password be guessed offline
+            data = _exchange(sock2, message.encode(), remote_address, invitation, reporter, metrics,
+              (TRACE_AUTH, TRACE_AUTH_REPLY), lambda: _connected(sock), ('%d %s' % (AUTH, cnonce)).encode(),
+              lambda answer: answer.startswith(b'AUTH') and (answer.split()[1:2] == [] or
+                answer.split()[1].decode() in nonces or len(nonces) >= MAX_NONCES),
+              again = invitation_message, interval = max(RETRANSMIT_MIN, waited))
+            if data is None or not data.startswith(b'AUTH'):
+              break
+            nonce = data.split()[1].decode()
+          if data is None:
+            reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Device connecting, its answer was lost')
+            data = b'OK'
+          data = data.decode()
+        except (socket.error, ValueError):
+          metrics.record(TRACE_TIMEOUT, int((time.perf_counter() - started) * 1000), data = b'auth')
+          invitation.missed()
+          reporter.write('FAIL\n')
+          reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No Answer to our Authentication')
+          return metrics.fail('auth_no_answer')
+        if (data != "OK"):
+          reporter.write('FAIL\n')
+          reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: ' + data)
+          return metrics.fail('auth_rejected')
+        reporter.write('OK\n')
+      else:
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Bad Answer: ' + data)
+        return metrics.fail('bad_answer')
+  finally:
+    sock2.close()
+
+  metrics.begin('accept')
+  reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Waiting for device...')
+  accept = timeouts['accept']
+  started = time.perf_counter()
+  try:
+    if isinstance(sock, _Route):
+      connection, client_address = sock.accept(accept.timeout, reporter)
+    else:
+      wait_readable(sock, accept.timeout, reporter)
+      connection, client_address = sock.accept()
+    connection.settimeout(None)
+    metrics.record(TRACE_ACCEPT)
+    accept.sample(time.perf_counter() - started)
+  except socket.error:
+    metrics.record(TRACE_TIMEOUT, int((time.perf_counter() - started) * 1000), data = b'accept')
+    accept.missed()
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No response from device')
+    return metrics.fail('no_response')
+
+  try:
+    if (PROGRESS):
+      update_progress(0, reporter)
+    else:
+      reporter.write('Uploading')
+    metrics.begin('transfer')
+    started = time.perf_counter()
+    try:
+      result_ok = _upload(connection, image, chunk_size, window, reporter, metrics, sendfile, timeouts['chunk'],
+        governor.throttle(remoteAddr) if governor is not None else None)
+    except socket.error as e:
+      if isinstance(e, socket.timeout):
+        metrics.record(TRACE_TIMEOUT, int(timeouts['chunk'].timeout() * 1000), data = b'chunk')
+      timeouts['chunk'].missed()
+      reporter.write('\n')
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Error Uploading')
+      return metrics.fail('upload')
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    reporter.write('\n')
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Sent %d bytes in %.2f s (%.1f kB/s)' % (content_size, elapsed, content_size / elapsed / 1024))
+
+    metrics.begin('result')
+    reporter.write('\n')
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Waiting for result...')
+    # libraries/ArduinoOTA/ArduinoOTA.cpp L311 L320
+    # only sends digits or 'OK'. We must not not close
+    # the connection before receiving the 'O' of 'OK'
+    result = timeouts['result']
+    started = time.perf_counter()
+    try:
+      deadline = time.time() + result.timeout()
+      while not result_ok:
+        wait_readable(connection, deadline - time.time(), reporter)
+        received = connection.recv(32)
+        metrics.record(TRACE_RESULT, data = received)
+        received = received.decode()
+        if not received:
+          raise socket.error('connection closed')
+        result_ok = received.find('O') >= 0
+        if result_ok:
+          result.sample(time.perf_counter() - started)
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Result: OK')
+      return 0
+    except (socket.error, ValueError) as e:
+      if isinstance(e, socket.timeout):
+        metrics.record(TRACE_TIMEOUT, int((time.perf_counter() - started) * 1000), data = b'result')
+      result.missed()
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: No Result!')
+      return metrics.fail('no_result')
+
+  finally:
+    connection.close()
+# end serve
+
+# parse_targets() : splits "ip[:port], ip[:port] ..." into (ip, port) tuples.
+def parse_targets(text, default_port):
+  targets = []
+  for item in text.replace(';', ',').replace(' ', ',').split(','):
+    if not item:
+      continue
+    host, sep, port = item.partition(':')
+    targets.append((host, int(port) if sep else default_port))
+  return targets
+
+# fleet_port() : host port used by the index-th session of a fleet run, so
+## that concurrent sessions never share a listening socket.
+def fleet_port(basePort, index):
+  return 10000 + (basePort - 10000 + index) % 50000
+
+# serve_fleet() : runs serve() for every (ip, port) of targets, at most
+## concurrency sessions at a time. Returns a list of (device, result).
+## Extra keyword arguments (chunk_size, window, cache, compress) are passed
+## to serve(). on_result(device, result) is called as each session ends.
+## passwords maps a device ("ip:port") to its own password.
+def serve_fleet(targets, localAddr, localPort, password, filename, command = FLASH, concurrency = 4, reporter = None,
+    shared = False, on_result = None, passwords = None, **kwargs):
+  # asyncio takes longer to import than the rest of the engine, a run for one
+  ## device does not need it
+  import asyncio
+  if reporter is None:
+    reporter = Reporter()
+  # the sessions start from the timeouts measured on the devices already seen
+  fleet_timeouts = kwargs.pop('timeouts', None) or Timeouts()
+  started = time.perf_counter()
+  image = open_image(filename, kwargs.get('cache'), kwargs.get('compress'), command, reporter, kwargs.get('check', True),
+    kwargs.get('flash_size'))
+  reporter.event('phase', device = '*', phase = 'hash', seconds = time.perf_counter() - started)
+  if image is None:
+    return [('%s:%d' % target, 1) for target in targets]
+  listener = None
+  try:
+    if shared:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Starting on '+str(localAddr)+":"+str(localPort))
+      try:
+        listener = SharedListener(localAddr, localPort, reporter)
+      except socket.error:
+        reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[ERROR]:Listen Failed")
+        return [('%s:%d' % target, 1) for target in targets]
+    return asyncio.run(_serve_fleet(targets, localAddr, localPort, password, image, command, concurrency, reporter,
+      listener, fleet_timeouts, on_result, passwords or {}, kwargs))
+  finally:
+    if listener is not None:
+      listener.close()
+    image.close()
+
+async def _serve_fleet(targets, localAddr, localPort, password, image, command, concurrency, reporter, listener, timeouts,
+    on_result, passwords, kwargs):
+  import asyncio
+  import concurrent.futures
+  loop = asyncio.get_running_loop()
+  concurrency = max(1, min(concurrency, len(targets)))
+  semaphore = asyncio.Semaphore(concurrency)
+  # serve() is blocking, each running session gets its own thread
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers = concurrency)
+  percents = {}
+  lock = threading.Lock()
+  # the dashboards list the whole fleet before it starts
+  for remoteAddr, remotePort in targets:
+    reporter.device_status('%s:%d' % (remoteAddr, remotePort), {'phase': 'queued'})
+
+  def on_progress(name, percent):
+    with lock:
+      percents[name] = percent
+      total = sum(percents.values()) // len(targets)
+    reporter.progress(total)
+
+  async def session(index, remoteAddr, remotePort):
+    name = '%s:%d' % (remoteAddr, remotePort)
+    async with semaphore:
+      if reporter.cancelled():
+        return (name, 1)
+      sub = SessionReporter(reporter, name, on_progress)
+      result = await loop.run_in_executor(executor, functools.partial(serve, remoteAddr, localAddr, remotePort,
+        fleet_port(localPort, index), passwords.get(name, password), image, command, sub, listener = listener,
+        timeouts = timeouts.session(),
+        **kwargs))
+      if on_result is not None:
+        on_result(name, result)
+      return (name, result)
+
+  try:
+    return await asyncio.gather(*[session(i, ip, port) for i, (ip, port) in enumerate(targets)])
+  finally:
+    executor.shutdown()
+# end serve_fleet
+
+# plan_waves() : splits count devices in waves, a canary percent of them
+## first (at least one device) and then waves growth times larger than the
+## previous one. Returns (start, end) index ranges.
+def plan_waves(count, canary = 5.0, growth = 2.0):
+  waves = []
+  start = 0
+  size = max(1, int(math.ceil(count * canary / 100.0)))
+  while start < count:
+    waves.append((start, min(count, start + size)))
+    start += size
+    size = max(size + 1, int(size * growth))
+  return waves
+
+# RolloutState : devices already updated with an image, kept in a JSON file
+## after every device so that an interrupted or stopped rollout resumes
+## where it was. A new image starts a new rollout, a finished one is
+## cleared.
+class RolloutState(object):
+  def __init__(self, filename, image_md5):
+    self.filename = filename
+    self.image = image_md5
+    self.devices = {}
+    if filename:
+      try:
+        with open(filename) as f:
+          data = json.load(f)
+        if data.get('image') == image_md5:
+          self.devices = dict(data.get('devices', {}))
+      except (IOError, OSError, ValueError, TypeError, AttributeError):
+        pass
+
+  def done(self, name):
+    return self.devices.get(name) == 'done'
+
+  def record(self, name, result):
+    self.devices[name] = 'done' if result == 0 else 'failed'
+    self._save()
+
+  def clear(self):
+    self.devices = {}
+    if not self.filename:
+      return
+    try:
+      os.remove(self.filename)
+    except (IOError, OSError):
+      pass
+
+  def _save(self):
+    if not self.filename:
+      return
+    try:
+      folder = os.path.dirname(self.filename)
+      if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+      with open(self.filename + '.tmp', 'w') as f:
+        json.dump({'time': time.time(), 'image': self.image, 'devices': self.devices}, f, indent = 1)
+      os.replace(self.filename + '.tmp', self.filename)
+    except (IOError, OSError):
+      pass
+
+# Ledger : outcome of every update, appended to a JSON lines file (device,
+## image MD5, command, time and result). The last success of every device
+## and command is indexed in memory: deployed() is a dictionary lookup.
+class Ledger(object):
+  def __init__(self, filename = LEDGER_FILE):
+    self.filename = filename
+    self._deployed = {}
+    self._lock = threading.Lock()
+    try:
+      with open(filename) as f:
+        for line in f:
+          try:
+            self._index(json.loads(line))
+          except (ValueError, AttributeError):
+            # a line cut short by a crash
+            continue
+    except (IOError, OSError):
+      pass
+
+  def _index(self, record):
+    if record.get('result') == 0:
+      self._deployed[(record.get('device'), record.get('command', FLASH))] = record
+
+  def last(self, device, command = FLASH):
+    return self._deployed.get((device, command))
+
+  def deployed(self, device, md5, command = FLASH):
+    record = self.last(device, command)
+    return record is not None and record.get('md5') == md5
+
+  def record(self, device, md5, command, result):
+    record = {'device': device, 'md5': md5, 'command': command, 'time': time.time(), 'result': result}
+    with self._lock:
+      self._index(record)
+      # the ledger is a record, failing to write it does not fail the update
+      try:
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.isdir(folder):
+          os.makedirs(folder)
+        with open(self.filename, 'a') as f:
+          f.write(json.dumps(record, sort_keys = True) + '\n')
+      except (IOError, OSError):
+        pass
+
+# rollout() : serve_fleet() wave after wave (see plan_waves()). A wave only
+## starts while the failure rate of the previous one is at most
+## max_failure; devices done in an earlier run of the same image are
+## skipped. Returns (results, stopped, resumed): the results of this run
+## and the devices done in an earlier one.
+def rollout(targets, localAddr, localPort, password, filename, command = FLASH, concurrency = 4, reporter = None,
+    canary = 5.0, growth = 2.0, max_failure = 0.1, state_file = ROLLOUT_FILE, on_result = None, **kwargs):
+  if reporter is None:
+    reporter = Reporter()
+  try:
+    image_md5 = image_digest(filename, kwargs.get('cache'))
+  except (IOError, OSError, ValueError) as e:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Cannot read image: '+str(e))
+    return [('%s:%d' % target, 1) for target in targets], True, []
+  state = RolloutState(state_file, image_md5)
+
+  def record(name, result):
+    state.record(name, result)
+    if on_result is not None:
+      on_result(name, result)
+  names = ['%s:%d' % target for target in targets]
+  resumed = [name for name in names if state.done(name)]
+  if resumed:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Resuming rollout, %d devices already updated' % len(resumed))
+  # the fleet timeouts carry over from wave to wave
+  kwargs.setdefault('timeouts', Timeouts())
+  waves = plan_waves(len(targets), canary, growth)
+  results = []
+  for number, (start, end) in enumerate(waves, 1):
+    wave = [target for target in targets[start:end] if not state.done('%s:%d' % target)]
+    if not wave:
+      continue
+    if reporter.cancelled():
+      return results, True, resumed
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Wave %d/%d: %d devices' % (number, len(waves), len(wave)))
+    done = serve_fleet(wave, localAddr, localPort, password, filename, command, concurrency, reporter,
+      on_result = record, **kwargs)
+    results.extend(done)
+    failed = sum(1 for name, result in done if result != 0)
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Wave %d/%d: %d/%d devices updated' % (number, len(waves), len(done) - failed, len(done)))
+    if failed > max_failure * len(done):
+      reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+'[ERROR]: Rollout stopped, %d%% of wave %d failed (limit %d%%). Run it again to resume.' % (100 * failed // len(done), number, int(max_failure * 100)))
+      return results, True, resumed
+  state.clear()
+  return results, False, resumed
+
+# Discovery
+## browse_mdns() asks for the _arduino._tcp services announced by ArduinoOTA
+## and scan() probes every address of a network on the OTA port. The probe
+## is an invitation for an empty image: ArduinoOTA answers it ("OK", or
+## "AUTH nonce" when protected) and then drops it at Update.begin(), before
+## anything is written. A protected device is sent a dummy AUTH message so
+## that it does not wait for one anymore.
+MDNS_ADDRESS = ('224.0.0.251', 5353)
+MDNS_SERVICE = '_arduino._tcp.local'
+EMPTY_MD5 = hashlib.md5(b'').hexdigest()
+
+def _dns_name(packet, offset):
+  labels = []
+  end = None
+  for _ in range(128):
+    length = packet[offset]
+    if length >= 0xc0:
+      if end is None:
+        end = offset + 2
+      offset = ((length & 0x3f) << 8) | packet[offset + 1]
+      continue
+    offset += 1
+    if length == 0:
+      break
+    labels.append(packet[offset:offset + length].decode('utf-8', 'replace'))
+    offset += length
+  return '.'.join(labels), end if end is not None else offset
+
+# _dns_records() : (name, type, rdata offset, rdata length) of every record
+## of an answer.
+def _dns_records(packet):
+  questions, answers, authorities, additionals = struct.unpack('!4H', packet[4:12])
+  offset = 12
+  for _ in range(questions):
+    offset = _dns_name(packet, offset)[1] + 4
+  records = []
+  for _ in range(answers + authorities + additionals):
+    name, offset = _dns_name(packet, offset)
+    rtype, rclass, ttl, length = struct.unpack('!HHIH', packet[offset:offset + 10])
+    offset += 10
+    records.append((name.lower(), rtype, offset, length))
+    offset += length
+  return records
+
+def browse_mdns(timeout = 2.0, service = MDNS_SERVICE):
+  # one-shot (legacy unicast) query: the answers come back to our port
+  query = struct.pack('!6H', 0, 0, 1, 0, 0, 0)
+  for label in service.split('.'):
+    query += struct.pack('!B', len(label)) + label.encode()
+  query += b'\0' + struct.pack('!2H', 12, 1)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  addresses, services, texts, instances = {}, {}, {}, set()
+  try:
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+    sock.sendto(query, MDNS_ADDRESS)
+    deadline = time.time() + timeout
+    while True:
+      left = deadline - time.time()
+      if left <= 0 or not _ready(sock, left):
+        break
+      packet, sender = sock.recvfrom(9000)
+      try:
+        for name, rtype, offset, length in _dns_records(packet):
+          if rtype == 1 and length == 4:
+            addresses[name] = socket.inet_ntoa(packet[offset:offset + 4])
+          elif rtype == 12 and name == service.lower():
+            instances.add(_dns_name(packet, offset)[0].lower())
+          elif rtype == 33:
+            port = struct.unpack('!H', packet[offset + 4:offset + 6])[0]
+            services[name] = (_dns_name(packet, offset + 6)[0].lower(), port)
+          elif rtype == 16:
+            text, end = [], offset + length
+            while offset < end:
+              text.append(packet[offset + 1:offset + 1 + packet[offset]].decode('utf-8', 'replace'))
+              offset += 1 + packet[offset]
+            texts[name] = text
+      except (IndexError, struct.error):
+        continue
+  except socket.error:
+    pass
+  finally:
+    sock.close()
+
+  devices = []
+  for instance in sorted(instances):
+    if instance not in services or services[instance][0] not in addresses:
+      continue
+    host, port = services[instance]
+    devices.append({
+      'ip': addresses[host],
+      'port': port,
+      'name': instance.split('.')[0],
+      'auth': 'auth_upload=yes' in texts.get(instance, []),
+      'source': 'mdns',
+    })
+  return devices
+
+def scan(network, port = 8266, timeout = 2.0, rate = 1000):
+  scanned = ipaddress.ip_network(network, strict = False)
+  hosts = list(scanned.hosts())
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.setblocking(False)
+  found = collections.OrderedDict()
+  try:
+    sock.bind(('', 0))
+    probe = ('%d %d %d %s\n' % (FLASH, sock.getsockname()[1], 0, EMPTY_MD5)).encode()
+    started = time.time()
+    deadline = started + len(hosts) / float(rate) + timeout
+    sent = 0
+    while True:
+      now = time.time()
+      if now >= deadline:
+        break
+      # probes are paced at rate per second
+      while sent < len(hosts) and sent < (now - started) * rate + 1:
+        try:
+          sock.sendto(probe, (str(hosts[sent]), port))
+        except socket.error:
+          pass
+        sent += 1
+      if _ready(sock, 0.01 if sent < len(hosts) else deadline - now):
+        try:
+          data, sender = sock.recvfrom(128)
+        except socket.error:
+          continue
+        # an ESP8266 without password answers "ERR: ..." (Update.begin()
+        ## refuses the empty image), any answer is a device
+        if sender[0] in found or ipaddress.ip_address(sender[0]) not in scanned:
+          continue
+        auth = data.startswith(b'AUTH')
+        if auth:
+          try:
+            sock.sendto(('%d 0 0\n' % AUTH).encode(), sender)
+          except socket.error:
+            pass
+        found[sender[0]] = {'ip': sender[0], 'port': sender[1], 'name': '', 'auth': auth, 'source': 'scan'}
+  finally:
+    sock.close()
+  return list(found.values())
+
+# probe() : which of targets, (ip, port) tuples, answer an empty invitation
+## (the probe of scan()), in a few seconds for a whole fleet. Probes are
+## paced at rate per second with at most concurrency targets waiting for
+## their answer, and sent again to the silent ones at growing intervals
+## until each has waited timeout. A device asking for a password gets a
+## wrong answer so that it leaves the authentication at once. Returns the
+## set of the targets that answered.
+def probe(targets, timeout = 2.0, rate = 1000, concurrency = 256, reporter = None):
+  if reporter is None:
+    reporter = Reporter()
+  queue = collections.deque(targets)
+  byAddress = collections.defaultdict(list)
+  for target in targets:
+    byAddress[target[0]].append(target)
+  # target: [deadline, next send, interval]
+  pending = collections.OrderedDict()
+  reachable = set()
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.setblocking(False)
+
+  def send(target):
+    try:
+      sock.sendto(message, target)
+    except socket.error:
+      pass
+
+  try:
+    sock.bind(('', 0))
+    message = ('%d %d %d %s\n' % (FLASH, sock.getsockname()[1], 0, EMPTY_MD5)).encode()
+    started = time.time()
+    sent = 0
+    while queue or pending:
+      reporter.check()
+      now = time.time()
+      while queue and len(pending) < concurrency and sent < (now - started) * rate + 1:
+        target = queue.popleft()
+        send(target)
+        sent += 1
+        pending[target] = [now + timeout, now + RETRANSMIT_FIRST, RETRANSMIT_FIRST * 2]
+      wake = now + 0.05
+      for target, state in list(pending.items()):
+        if now >= state[0]:
+          del pending[target]
+          continue
+        if now >= state[1]:
+          send(target)
+          state[1] = now + state[2]
+          state[2] *= 2
+        wake = min(wake, state[0], state[1])
+      if not _ready(sock, wake - now):
+        continue
+      while True:
+        try:
+          data, sender = sock.recvfrom(128)
+        except socket.error:
+          break
+        # devices answer from their OTA port, "ERR: ..." when they have no
+        ## password (see scan())
+        target = sender if sender in pending else next((t for t in byAddress.get(sender[0], ()) if t in pending), None)
+        if target is None:
+          continue
+        del pending[target]
+        reachable.add(target)
+        if data.startswith(b'AUTH'):
+          try:
+            sock.sendto(('%d 0 0\n' % AUTH).encode(), sender)
+          except socket.error:
+            pass
+  finally:
+    sock.close()
+  return reachable
+
+# ProbeCache : the last probe() answer of every device, trusted for ttl
+## seconds so that runs following each other do not probe again.
+class ProbeCache(object):
+  def __init__(self, filename = PROBE_FILE, ttl = 60.0):
+    self.filename = filename
+    self.ttl = ttl
+    try:
+      with open(filename) as f:
+        self.devices = json.load(f)['devices']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+      self.devices = {}
+
+  # get() : True or False, None when the device was not probed lately.
+  def get(self, name):
+    entry = self.devices.get(name)
+    if entry is None or not 0 <= time.time() - entry[0] < self.ttl:
+      return None
+    return entry[1]
+
+  def put(self, name, reachable):
+    self.devices[name] = [time.time(), reachable]
+
+  def save(self):
+    now = time.time()
+    try:
+      folder = os.path.dirname(self.filename)
+      if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+      devices = dict((name, entry) for name, entry in self.devices.items() if now - entry[0] < self.ttl)
+      with open(self.filename + '.tmp', 'w') as f:
+        json.dump({'time': now, 'devices': devices}, f)
+      os.replace(self.filename + '.tmp', self.filename)
+    except (IOError, OSError):
+      pass
+
+# probe_targets() : the targets that can be updated now, probed with
+## probe() unless cache knows them, in the order of targets.
+def probe_targets(targets, cache = None, timeout = 2.0, reporter = None):
+  known = {}
+  if cache is not None:
+    for target in targets:
+      reachable = cache.get('%s:%d' % target)
+      if reachable is not None:
+        known[target] = reachable
+  probed = probe([target for target in targets if target not in known], timeout, reporter = reporter)
+  if cache is not None:
+    for target in targets:
+      if target not in known:
+        cache.put('%s:%d' % target, target in probed)
+    cache.save()
+  return [target for target in targets if known.get(target, target in probed)]
+
+# local_network() : the /24 of the address used to reach other networks.
+def local_network():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    # connecting an UDP socket sends nothing
+    sock.connect(('10.255.255.255', 1))
+    address = sock.getsockname()[0]
+  except socket.error:
+    address = '127.0.0.1'
+  finally:
+    sock.close()
+  return str(ipaddress.ip_network(address + '/24', strict = False))
+
+# discover() : devices found by mDNS and/or by scanning network, merged by
+## address, sorted by address and saved to the device list.
+def discover(mdns = True, network = None, port = 8266, timeout = 2.0, filename = DEVICES_FILE):
+  import concurrent.futures
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers = 2) as executor:
+    jobs = []
+    if mdns:
+      jobs.append(executor.submit(browse_mdns, timeout))
+    if network:
+      jobs.append(executor.submit(scan, network, port, timeout))
+    for job in jobs:
+      results.extend(job.result())
+  devices = collections.OrderedDict()
+  for device in results:
+    known = devices.get(device['ip'])
+    if known is None:
+      devices[device['ip']] = device
+    elif not known['name']:
+      known['name'] = device['name']
+  devices = sorted(devices.values(), key = lambda device: ipaddress.ip_address(device['ip']))
+  if filename:
+    save_devices(devices, filename)
+  return devices
+
+def save_devices(devices, filename = DEVICES_FILE):
+  try:
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+      os.makedirs(folder)
+    with open(filename + '.tmp', 'w') as f:
+      json.dump({'time': time.time(), 'devices': devices}, f, indent = 1)
+    os.replace(filename + '.tmp', filename)
+  except (IOError, OSError):
+    pass
+
+def load_devices(filename = DEVICES_FILE):
+  try:
+    with open(filename) as f:
+      return json.load(f)['devices']
+  except (IOError, OSError, ValueError, KeyError, TypeError):
+    return []
+
+# Inventory : devices with their own port, password, group, name and
+## firmware (a label, or the MD5 of the last image flashed), keyed by
+## "ip:port". Indexed by group, subnet and firmware so that a selection
+## among thousands of devices does not go through all of them. Devices are
+## checked once, when they are added; imported from CSV (a header line names
+## the columns, see COLUMNS) or JSON (a list of objects), saved as JSON.
+class Inventory(object):
+  COLUMNS = ('ip', 'port', 'password', 'group', 'name', 'firmware')
+
+  def __init__(self, filename = INVENTORY_FILE, prefix = 24):
+    self.filename = filename
+    self.prefix = prefix
+    self.devices = collections.OrderedDict()
+    self._groups = {}
+    self._subnets = {}
+    self._firmwares = {}
+    try:
+      with open(filename) as f:
+        for device in json.load(f)['devices']:
+          self._add(device)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+      pass
+
+  @staticmethod
+  def key(device):
+    return '%s:%d' % (device['ip'], device['port'])
+
+  def subnet(self, ip):
+    return str(ipaddress.ip_network('%s/%d' % (ip, self.prefix), strict = False))
+
+  def add(self, row, default_port = 8266):
+    port = int(row.get('port') or default_port)
+    if not 0 < port < 65536:
+      raise ValueError('port %d' % port)
+    device = {'ip': str(ipaddress.ip_address(str(row['ip']).strip())), 'port': port}
+    for column in self.COLUMNS[2:]:
+      device[column] = str(row.get(column) or '').strip()
+    self._add(device)
+    return device
+
+  def _add(self, device):
+    key = self.key(device)
+    if key in self.devices:
+      self._unindex(key)
+    self.devices[key] = device
+    self._groups.setdefault(device['group'], set()).add(key)
+    self._subnets.setdefault(self.subnet(device['ip']), set()).add(key)
+    self._firmwares.setdefault(device['firmware'], set()).add(key)
+
+  def _unindex(self, key):
+    device = self.devices[key]
+    for index, value in ((self._groups, device['group']), (self._subnets, self.subnet(device['ip'])),
+        (self._firmwares, device['firmware'])):
+      index[value].discard(key)
+      if not index[value]:
+        del index[value]
+
+  # import_file() : adds the devices of a CSV or JSON file, returns the
+  ## number of devices added and of rows rejected.
+  def import_file(self, filename, default_port = 8266):
+    with open(filename) as f:
+      if filename.lower().endswith('.json'):
+        rows = json.load(f)
+        if isinstance(rows, dict):
+          rows = rows.get('devices', [])
+      else:
+        rows = list(csv.DictReader(f))
+    added = rejected = 0
+    for row in rows:
+      try:
+        self.add(row, default_port)
+        added += 1
+      except (ValueError, KeyError, TypeError, AttributeError):
+        rejected += 1
+    return added, rejected
+
+  # select() : devices in group, in the subnet and with the firmware, each
+  ## criterion None for any. Sorted by address.
+  def select(self, group = None, subnet = None, firmware = None):
+    keys = None
+    if group is not None:
+      keys = set(self._groups.get(group, ()))
+    if subnet is not None:
+      network = ipaddress.ip_network(subnet, strict = False)
+      found = set()
+      for name, members in self._subnets.items():
+        indexed = ipaddress.ip_network(name)
+        if indexed.subnet_of(network):
+          found |= members
+        elif network.subnet_of(indexed):
+          found |= set(key for key in members if ipaddress.ip_address(self.devices[key]['ip']) in network)
+      keys = found if keys is None else keys & found
+    if firmware is not None:
+      found = self._firmwares.get(firmware, set())
+      keys = set(found) if keys is None else keys & found
+    if keys is None:
+      keys = self.devices.keys()
+    devices = [self.devices[key] for key in keys]
+    return sorted(devices, key = lambda device: (ipaddress.ip_address(device['ip']), device['port']))
+
+  def set_firmware(self, key, firmware):
+    device = self.devices.get(key)
+    if device is not None and device['firmware'] != firmware:
+      self._firmwares[device['firmware']].discard(key)
+      if not self._firmwares[device['firmware']]:
+        del self._firmwares[device['firmware']]
+      device['firmware'] = firmware
+      self._firmwares.setdefault(firmware, set()).add(key)
+
+  def save(self):
+    try:
+      folder = os.path.dirname(self.filename)
+      if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+      # the passwords are only readable by the user: a stale temporary
+      ## file would keep its mode, it is removed first
+      tmp = self.filename + '.tmp'
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump({'time': time.time(), 'devices': list(self.devices.values())}, f, indent = 1)
+      os.replace(tmp, self.filename)
+    except (IOError, OSError):
+      pass
+
+def parser(unparsed_args):
+  parser = optparse.OptionParser(
+    usage = "%prog [options]",
+    description = "Transmit image over the air to the esp8266 module with OTA support."
+  )
+
+  # destination ip and port
+  group = optparse.OptionGroup(parser, "Destination")
+  group.add_option("-i", "--ip",
+    dest = "esp_ip",
+    action = "store",
+    help = "ESP8266 IP Address. Several comma separated ip[:port] update a fleet.",
+    default = False
+  )
+  group.add_option("-I", "--host_ip",
+    dest = "host_ip",
+    action = "store",
+    help = "Host IP Address.",
+    default = "0.0.0.0"
+  )
+  group.add_option("-p", "--port",
+    dest = "esp_port",
+    type = "int",
+    help = "ESP8266 ota Port. Default 8266",
+    default = 8266
+  )
+  group.add_option("-j", "--jobs",
+    dest = "jobs",
+    type = "int",
+    help = "Number of devices updated at the same time when several IP addresses are given. Default 4",
+    default = 4
+  )
+  group.add_option("-P", "--host_port",
+    dest = "host_port",
+    type = "int",
+    help = "Host server ota Port. Default random 10000-60000",
+    default = random.randint(10000,60000)
+  )
+  group.add_option("--shared_port",
+    dest = "shared_port",
+    action = "store_true",
+    help = "All the devices of a fleet connect back to the host port instead of one port each.",
+    default = False
+  )
+  parser.add_option_group(group)
+
+  # discovery
+  group = optparse.OptionGroup(parser, "Discovery", "Without -i the devices found are updated, without -f they are only listed.")
+  group.add_option("--mdns",
+    dest = "mdns",
+    action = "store_true",
+    help = "Look for devices announced by mDNS.",
+    default = False
+  )
+  group.add_option("--scan",
+    dest = "scan",
+    help = "Probe every address of NETWORK (for example 192.168.1.0/24) on the ESP port.",
+    metavar = "NETWORK",
+    default = None
+  )
+  group.add_option("--discovery_time",
+    dest = "discovery_time",
+    type = "float",
+    help = "Time given to the devices to answer, in seconds. Default 2",
+    default = 2.0
+  )
+  group.add_option("--known",
+    dest = "known",
+    action = "store_true",
+    help = "Update the devices found by the last discovery (%s)." % DEVICES_FILE,
+    default = False
+  )
+  parser.add_option_group(group)
+
+  # inventory
+  group = optparse.OptionGroup(parser, "Inventory", "Without -i the devices of the inventory selected by --group, --subnet and --firmware are updated, with their own port and password.")
+  group.add_option("--inventory",
+    dest = "inventory",
+    help = "Inventory of the devices. Default ~/.espota/inventory.json",
+    metavar = "FILE",
+    default = INVENTORY_FILE
+  )
+  group.add_option("--import",
+    dest = "import_file",
+    help = "Add the devices of FILE to the inventory: CSV with the columns ip,port,password,group,name,firmware or JSON.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--group",
+    dest = "group",
+    help = "Select the devices of group NAME.",
+    metavar = "NAME",
+    default = None
+  )
+  group.add_option("--subnet",
+    dest = "subnet",
+    help = "Select the devices of NETWORK (for example 192.168.1.0/24).",
+    metavar = "NETWORK",
+    default = None
+  )
+  group.add_option("--firmware",
+    dest = "firmware",
+    help = "Select the devices running FIRMWARE (a label or an image MD5).",
+    default = None
+  )
+  parser.add_option_group(group)
+
+  # rollout
+  group = optparse.OptionGroup(parser, "Rollout", "Several devices can be updated in waves, the next wave only starts if the previous one went well.")
+  group.add_option("--canary",
+    dest = "canary",
+    type = "float",
+    help = "Update PERCENT of the devices first, then waves growing by --growth.",
+    metavar = "PERCENT",
+    default = None
+  )
+  group.add_option("--growth",
+    dest = "growth",
+    type = "float",
+    help = "Size of a wave compared to the previous one. Default 2",
+    default = 2.0
+  )
+  group.add_option("--max_failure",
+    dest = "max_failure",
+    type = "float",
+    help = "Percentage of failed devices in a wave that stops the rollout. Default 10",
+    default = 10.0
+  )
+  group.add_option("--state",
+    dest = "state",
+    help = "Progress of the rollout, a stopped rollout of the same image resumes from it. Default ~/.espota/rollout.json",
+    metavar = "FILE",
+    default = ROLLOUT_FILE
+  )
+  group.add_option("--skip_deployed",
+    dest = "skip_deployed",
+    action = "store_true",
+    help = "Send nothing to the devices the ledger shows already updated with this image.",
+    default = False
+  )
+  group.add_option("--ledger",
+    dest = "ledger",
+    help = "Every update is recorded in FILE. Default ~/.espota/ledger.jsonl",
+    metavar = "FILE",
+    default = LEDGER_FILE
+  )
+  group.add_option("--no_ledger",
+    dest = "no_ledger",
+    action = "store_true",
+    help = "Do not record the updates.",
+    default = False
+  )
+  parser.add_option_group(group)
+
+  # probe
+  group = optparse.OptionGroup(parser, "Probe", "All the devices can be probed at once before the update, the ones that do not answer are skipped.")
+  group.add_option("--probe",
+    dest = "probe",
+    action = "store_true",
+    help = "Probe the devices first and update the reachable ones only.",
+    default = False
+  )
+  group.add_option("--probe_timeout",
+    dest = "probe_timeout",
+    type = "float",
+    help = "Time given to a device to answer the probe in seconds. Default 2",
+    default = 2.0
+  )
+  group.add_option("--probe_ttl",
+    dest = "probe_ttl",
+    type = "float",
+    help = "Seconds the answer of a device is trusted, 0 to always probe. Default 60",
+    default = 60.0
+  )
+  group.add_option("--probe_cache",
+    dest = "probe_cache",
+    help = "Answers of the last probes. Default ~/.espota/probe.json",
+    metavar = "FILE",
+    default = PROBE_FILE
+  )
+  parser.add_option_group(group)
+
+  # watch
+  group = optparse.OptionGroup(parser, "Watch", "The devices can be updated with every image a build writes to a folder.")
+  group.add_option("--watch",
+    dest = "watch",
+    help = "Update the devices with every new or changed image of FOLDER, until interrupted.",
+    metavar = "FOLDER",
+    default = None
+  )
+  group.add_option("--pattern",
+    dest = "pattern",
+    help = "Names of the images in the watched folder. Default *.bin",
+    default = "*.bin"
+  )
+  group.add_option("--settle",
+    dest = "settle",
+    type = "float",
+    help = "Seconds an image must stay unchanged before it is sent. Default 2",
+    default = 2.0
+  )
+  group.add_option("--watch_interval",
+    dest = "watch_interval",
+    type = "float",
+    help = "Seconds between two looks at the folder. Default 1",
+    default = 1.0
+  )
+  parser.add_option_group(group)
+
+  # auth
+  group = optparse.OptionGroup(parser, "Authentication")
+  group.add_option("-a", "--auth",
+    dest = "auth",
+    help = "Set authentication password.",
+    action = "store",
+    default = ""
+  )
+  parser.add_option_group(group)
+
+  # image
+  group = optparse.OptionGroup(parser, "Image")
+  group.add_option("-f", "--file",
+    dest = "image",
+    help = "Image file.",
+    metavar="FILE",
+    default = None
+  )
+  group.add_option("-z", "--compress",
+    dest = "compress",
+    action = "store_true",
+    help = "Upload a gzip compressed image (ESP8266 core 2.7+, flashing only).",
+    default = False
+  )
+  group.add_option("--cache",
+    dest = "cache",
+    help = "Image digest cache. Default %s" % CACHE_FILE,
+    metavar = "FILE",
+    default = CACHE_FILE
+  )
+  group.add_option("--flash_size",
+    dest = "flash_size",
+    help = "Flash size of the devices (512K, 1M, 4M...), the image must fit. Default the size the image was built for",
+    default = None
+  )
+  group.add_option("--no_check",
+    dest = "check",
+    action = "store_false",
+    help = "Send the image without checking its headers first.",
+    default = True
+  )
+  group.add_option("--no_cache",
+    dest = "no_cache",
+    action = "store_true",
+    help = "Always hash the image, do not use the digest cache.",
+    default = False
+  )
+  group.add_option("-s", "--spiffs",
+    dest = "spiffs",
+    action = "store_true",
+    help = "Use this option to transmit a SPIFFS image and do not flash the module.",
+    default = False
+  )
+  parser.add_option_group(group)
+
+  # transfer
+  group = optparse.OptionGroup(parser, "Transfer")
+  group.add_option("-c", "--chunk_size",
+    dest = "chunk_size",
+    type = "int",
+    help = "Size of the upload chunks. Default 1460",
+    default = 1460
+  )
+  group.add_option("-w", "--window",
+    dest = "window",
+    type = "int",
+    help = "Number of chunks sent ahead of the device acks. Default 1 (wait for every ack)",
+    default = 1
+  )
+  group.add_option("--retries",
+    dest = "retries",
+    type = "int",
+    help = "Retries of a device after a transient failure (no answer, upload error). Default 2",
+    default = 2
+  )
+  group.add_option("--retry_delay",
+    dest = "retry_delay",
+    type = "float",
+    help = "Delay before the first retry in seconds, doubled at every retry. Default 1",
+    default = 1.0
+  )
+  group.add_option("--timeout_min",
+    dest = "timeout_min",
+    type = "float",
+    help = "Shortest wait for an answer of a device in seconds. Default 1",
+    default = 1.0
+  )
+  group.add_option("--timeout_max",
+    dest = "timeout_max",
+    type = "float",
+    help = "Longest wait for an answer of a device in seconds, the result may take 6 times longer. Default 10",
+    default = 10.0
+  )
+  group.add_option("--max_rate",
+    dest = "max_rate",
+    type = "float",
+    help = "Total upload rate of all the devices in kB/s. Default no limit",
+    default = None
+  )
+  group.add_option("--group_rate",
+    dest = "group_rate",
+    type = "float",
+    help = "Upload rate of every group of devices (subnet, see --group_prefix) in kB/s. Default no limit",
+    default = None
+  )
+  group.add_option("--group_prefix",
+    dest = "group_prefix",
+    type = "int",
+    help = "Prefix length of the subnets grouped by --group_rate. Default 24",
+    default = 24
+  )
+  group.add_option("--no_sendfile",
+    dest = "sendfile",
+    action = "store_false",
+    help = "Send the image from memory instead of with sendfile.",
+    default = True
+  )
+  parser.add_option_group(group)
+
+  # output group
+  group = optparse.OptionGroup(parser, "Output")
+  group.add_option("-d", "--debug",
+    dest = "debug",
+    help = "Show debug output. And override loglevel with debug.",
+    action = "store_true",
+    default = False
+  )
+  group.add_option("--metrics",
+    dest = "metrics",
+    help = "Append the timing events of every session to FILE as JSON lines.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--prometheus",
+    dest = "prometheus",
+    help = "Write the timings of the last session of every device to FILE in Prometheus text format.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--trace",
+    dest = "trace",
+    help = "Record the protocol events of every session to FILE, for EspotaReplay.py.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("-r", "--progress",
+    dest = "progress",
+    help = "Show progress output. Does not work for ArduinoIDE",
+    action = "store_true",
+    default = False
+  )
+  parser.add_option_group(group)
+
+  (options, args) = parser.parse_args(unparsed_args)
+
+  return options
+# end parser
+
+
+def flashing(args, reporter = None):
+ # get options
+  options = parser(args)
+  if reporter is None:
+    reporter = Reporter()
+
+  if options.debug:
+    shown = dict(vars(options))
+    if shown['auth']:
+      shown['auth'] = '***'
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[DEBUG]: Options: "+str(shown))
+
+  # check options
+  global PROGRESS
+  PROGRESS = options.progress
+  discovered = None
+  if options.mdns or options.scan:
+    try:
+      discovered = discover(options.mdns, options.scan, options.esp_port, options.discovery_time)
+    except ValueError:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Invalid network: "+options.scan)
+      return 1
+  elif options.known:
+    discovered = load_devices()
+  if discovered is not None:
+    for device in discovered:
+      reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: Found %s:%d %s%s" % (device['ip'],
+        device['port'], device['name'], ' (password)' if device['auth'] else ''))
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d devices found" % len(discovered))
+    if not options.image and not options.watch:
+      return 0
+    if not options.esp_ip:
+      options.esp_ip = ','.join('%s:%d' % (device['ip'], device['port']) for device in discovered)
+      if not discovered:
+        return 1
+  inventory = None
+  selected = None
+  selection = options.group is not None or options.subnet is not None or options.firmware is not None
+  if options.import_file or selection:
+    inventory = Inventory(options.inventory, options.group_prefix)
+  if options.import_file:
+    try:
+      added, rejected = inventory.import_file(options.import_file, options.esp_port)
+    except (IOError, OSError, ValueError) as e:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Cannot import devices: "+str(e))
+      return 1
+    inventory.save()
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d devices imported, %d rejected, %d in the inventory" % (added, rejected, len(inventory.devices)))
+    if not options.image and not options.watch:
+      return 0
+  if selection and not options.esp_ip:
+    try:
+      selected = inventory.select(options.group, options.subnet, options.firmware)
+    except ValueError:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Invalid network: "+options.subnet)
+      return 1
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d devices selected in the inventory" % len(selected))
+    if not selected:
+      return 1
+  if ((not options.esp_ip and selected is None) or not (options.image or options.watch)):
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Not enough arguments.")
+
+    return 1
+  # end if
+
+  command = FLASH
+  if (options.spiffs):
+    command = SPIFFS
+  # end if
+
+  if selected is not None:
+    # checked when they were added to the inventory
+    targets = [(device['ip'], device['port']) for device in selected]
+  else:
+    try:
+      targets = parse_targets(options.esp_ip, options.esp_port)
+    except ValueError:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Invalid device list: "+options.esp_ip)
+      return 1
+  if options.chunk_size < 1 or options.window < 1:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Chunk size and window must be positive.")
+    return 1
+  if not 0 < options.timeout_min <= options.timeout_max:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: The timeouts must be positive, the minimum not above the maximum.")
+    return 1
+  if options.canary is not None and not (0 < options.canary <= 100 and options.growth >= 1 and 0 <= options.max_failure <= 100):
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Canary and failure percentages must be within 0-100, growth at least 1.")
+    return 1
+  if (options.max_rate is not None and options.max_rate <= 0) or (options.group_rate is not None and options.group_rate <= 0) \
+      or not 0 <= options.group_prefix <= 32:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Rates must be positive and the group prefix within 0-32.")
+    return 1
+  flash_size = None
+  if options.flash_size:
+    try:
+      flash_size = parse_flash_size(options.flash_size)
+    except ValueError:
+      flash_size = 0
+    if flash_size <= 0:
+      reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Invalid flash size: "+options.flash_size)
+      return 1
+  if options.retries < 0 or options.retry_delay < 0:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Retries and retry delay must not be negative.")
+    return 1
+  if options.watch and not (os.path.isdir(options.watch) and options.settle >= 0 and options.watch_interval > 0):
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Cannot watch %s, or invalid settle time or interval." % options.watch)
+    return 1
+  transfer = dict(chunk_size = options.chunk_size, window = options.window, compress = options.compress,
+    sendfile = options.sendfile, timeouts = Timeouts(options.timeout_min, options.timeout_max), check = options.check,
+    flash_size = flash_size)
+  if not options.no_cache:
+    transfer['cache'] = digest_cache(options.cache)
+  if options.retries:
+    transfer['retry'] = RetryPolicy(options.retries, options.retry_delay)
+  if selected is not None:
+    transfer['passwords'] = dict((Inventory.key(device), device['password']) for device in selected if device['password'])
+  if options.max_rate or options.group_rate:
+    # the inventory groups take the place of the subnets
+    groups = dict((device['ip'], device['group']) for device in selected if device['group']) if selected else None
+    transfer['governor'] = Governor(options.max_rate and options.max_rate * 1024, options.group_rate and options.group_rate * 1024,
+      options.group_prefix, groups)
+
+  exporters = []
+  try:
+    if options.metrics:
+      exporters.append(JsonLinesExporter(options.metrics))
+    if options.prometheus:
+      exporters.append(PrometheusExporter(options.prometheus))
+    if options.trace:
+      transfer['trace'] = TraceWriter(options.trace)
+  except (IOError, OSError) as e:
+    reporter.write((time.strftime("%H:%M:%S", time.gmtime()))+"[CRITICAL]: Cannot write metrics: "+str(e))
+    for exporter in exporters:
+      exporter.close()
+    return 1
+  reporter.listeners.extend(exporters)
+  try:
+    if options.watch:
+      return watch(targets, options, command, reporter, transfer, inventory)
+    return flash_targets(targets, options, command, reporter, transfer, inventory)
+  finally:
+    for exporter in exporters:
+      reporter.listeners.remove(exporter)
+      exporter.close()
+    if 'trace' in transfer:
+      transfer['trace'].close()
+# end main
+
+def flash_targets(targets, options, command, reporter, transfer, inventory = None):
+  passwords = transfer.pop('passwords', {})
+  ledger = None
+  image_md5 = None
+  try:
+    image_md5 = image_digest(options.image, transfer.get('cache'))
+    if not options.no_ledger:
+      ledger = Ledger(options.ledger)
+  except (IOError, OSError, ValueError):
+    # serve() reports why the image cannot be read
+    pass
+  on_result = None
+  if image_md5 is not None:
+    def on_result(name, result):
+      if ledger is not None:
+        ledger.record(name, image_md5, command, result)
+      # the inventory knows the firmware of its devices
+      if inventory is not None and result == 0 and command == FLASH:
+        inventory.set_firmware(name, image_md5)
+  if ledger is not None:
+    if options.skip_deployed:
+      count = len(targets)
+      targets = [target for target in targets if not ledger.deployed('%s:%d' % target, image_md5, command)]
+      if count > len(targets):
+        reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d devices already updated with this image, skipped" % (count - len(targets)))
+      if not targets:
+        return 0
+
+  unreachable = []
+  if options.probe:
+    started = time.time()
+    try:
+      reachable = probe_targets(targets, ProbeCache(options.probe_cache, options.probe_ttl), options.probe_timeout, reporter)
+    except Cancelled:
+      reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+'[INFO]: Cancelled')
+      return 1
+    unreachable = ['%s:%d' % target for target in targets if target not in reachable]
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d/%d devices reachable (%.1f s)" % (len(reachable), len(targets), time.time() - started))
+    for name in unreachable:
+      reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[ERROR]: Unreachable, skipped: "+name)
+      reporter.device_status(name, {'phase': 'probe', 'result': 1, 'error': 'unreachable'})
+    targets = reachable
+    if not targets:
+      return 1
+    # serve() starts a line of its own
+    if len(targets) == 1:
+      reporter.write('\n')
+
+  try:
+    result = _flash_targets(targets, options, command, reporter, transfer, passwords, on_result)
+    return 1 if unreachable else result
+  finally:
+    if inventory is not None:
+      inventory.save()
+
+# watch() : updates targets with the newest image FolderWatcher finds ready
+## in options.watch, again for every image written after it, until
+## interrupted or cancelled. Returns the result of the last update.
+def watch(targets, options, command, reporter, transfer, inventory = None):
+  watcher = FolderWatcher(options.watch, options.pattern, options.settle, transfer.get('cache'))
+  reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: Watching %s for %s" % (options.watch, options.pattern))
+  result = 0
+  try:
+    while not reporter._cancel.wait(options.watch_interval):
+      ready = watcher.poll()
+      if not ready:
+        continue
+      options.image = ready[-1]
+      reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: New image: "+options.image)
+      # flash_targets() takes the passwords out of transfer
+      result = flash_targets(targets, options, command, reporter, dict(transfer), inventory)
+      reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: Watching %s for %s" % (options.watch, options.pattern))
+  except KeyboardInterrupt:
+    pass
+  return result
+
+def _flash_targets(targets, options, command, reporter, transfer, passwords, on_result):
+  if len(targets) == 1:
+    name = '%s:%d' % targets[0]
+    result = serve(targets[0][0], options.host_ip, targets[0][1], options.host_port, passwords.get(name, options.auth),
+      options.image, command, reporter, **transfer)
+    if on_result is not None:
+      on_result(name, result)
+    return result
+
+  stopped = False
+  resumed = []
+  if options.canary is not None:
+    results, stopped, resumed = rollout(targets, options.host_ip, options.host_port, options.auth, options.image, command, options.jobs,
+      reporter, options.canary, options.growth, options.max_failure / 100.0, options.state, on_result = on_result,
+      shared = options.shared_port, passwords = passwords, **transfer)
+  else:
+    results = serve_fleet(targets, options.host_ip, options.host_port, options.auth, options.image, command, options.jobs, reporter,
+      shared = options.shared_port, on_result = on_result, passwords = passwords, **transfer)
+  failed = [name for name, result in results if result != 0]
+  reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d/%d devices updated" % (len(results) - len(failed), len(results)))
+  if resumed:
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[INFO]: %d devices updated by an earlier run" % len(resumed))
+  for name in failed:
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[ERROR]: Failed: "+name)
+  if stopped:
+    reporter.write('\n'+(time.strftime("%H:%M:%S", time.gmtime()))+"[ERROR]: %d devices not updated" % (len(targets) - len(results) - len(resumed)))
+  return 1 if failed or stopped else 0
+
+def main(args):
+  return flashing(args)
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))